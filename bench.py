@@ -0,0 +1,589 @@
+"""
+Benchmarks for quickbooks.py, run with python 2:
+
+    python bench.py memory [count]
+    python bench.py decode [pages]
+    python bench.py xml [customers]
+    python bench.py suite [options]     (python bench.py suite -h for them)
+
+memory: peak RSS of holding <count> (default 100000) synthetic invoices as
+plain dicts vs CompactEntity records. Each variant runs in its own process
+so they don't share an allocator high-water mark.
+
+decode: JSON decode throughput on <pages> (default 50) 500-record invoice
+QueryResponse pages, for the stdlib json module and whichever of
+JSONCodec's faster libraries are installed.
+
+xml: parse time for a v2 customers response with <customers> (default
+20000) customers, the old way (ET.fromstring, then ET.tostring and
+xmltodict.parse per customer; needs xmltodict) vs _iter_xml.
+
+suite: runs query_fetch_more, get_objects, CRUD, sparse updates, batch,
+reports and attachment uploads/downloads against MockQBO, a local
+stand-in for the v3 API with configurable latency, payload sizes and
+injected faults (Fault, 429, 503). Each scenario runs in its own client process; for each one it
+reports throughput, request latency percentiles, retries and peak RSS.
+"""
+
+import sys, subprocess, resource, random, json, time
+import re, os, threading, tempfile, urlparse, argparse
+import BaseHTTPServer, SocketServer
+
+def synthetic_invoice(i, rnd, lines=None):
+    """
+    Roughly the shape (and size) of an invoice out of a QBO query; lines
+    is how many Lines it gets (1-6 if not given).
+    """
+
+    line_count = lines or rnd.randint(1, 6)
+    lines = []
+    for n in range(line_count):
+        amount = round(rnd.uniform(1, 500), 2)
+        lines.append({
+            "Id": str(n + 1), "LineNum": n + 1, "Amount": amount,
+            "DetailType": "SalesItemLineDetail",
+            "SalesItemLineDetail": {
+                "ItemRef": {"value": str(rnd.randint(1, 200)), "name": "Item %d" % rnd.randint(1, 200)},
+                "UnitPrice": amount, "Qty": 1,
+                "TaxCodeRef": {"value": "NON"}}})
+
+    customer = rnd.randint(1, 2000)
+    return {
+        "Id": str(i), "SyncToken": "0", "domain": "QBO", "sparse": False,
+        "DocNumber": str(1000 + i), "TxnDate": "2015-%02d-%02d" % (rnd.randint(1, 12), rnd.randint(1, 28)),
+        "CurrencyRef": {"value": "USD", "name": "United States Dollar"},
+        "CustomerRef": {"value": str(customer), "name": "Customer %d" % customer},
+        "SalesTermRef": {"value": "3"},
+        "MetaData": {"CreateTime": "2015-01-01T10:00:00-08:00", "LastUpdatedTime": "2015-01-02T10:00:00-08:00"},
+        "TotalAmt": sum(line["Amount"] for line in lines), "Balance": 0,
+        "PrintStatus": "NotSet", "EmailStatus": "NotSet",
+        "Line": lines}
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def memory_child(variant, count):
+    from quickbooks import CompactEntity
+
+    rnd = random.Random(1)
+    baseline = peak_rss_kb()
+    held = {}
+    for i in xrange(count):
+        # round trip through json, like a real page, so nothing is shared
+        entity = json.loads(json.dumps(synthetic_invoice(i, rnd)))
+        if variant == "compact":
+            entity = CompactEntity("Invoice", entity)
+
+        held[entity["Id"]] = entity
+
+    print peak_rss_kb() - baseline
+
+def memory(count=100000):
+    results = {}
+    for variant in ("dict", "compact"):
+        out = subprocess.check_output([sys.executable, __file__, "_memory", variant, str(count)])
+        results[variant] = int(out.strip())
+
+    print "%d invoices" % count
+    for variant in ("dict", "compact"):
+        print "  %-8s %8.1f MB" % (variant, results[variant] / 1024.0)
+
+    print "  reduction %.0f%%" % (100.0 * (1 - float(results["compact"]) / results["dict"]))
+
+def query_page(rnd, start, size=500):
+    invoices = [synthetic_invoice(i, rnd) for i in xrange(start, start + size)]
+    return json.dumps({
+        "QueryResponse": {"Invoice": invoices, "startPosition": start, "maxResults": size},
+        "time": "2015-01-01T10:00:00.000-08:00"})
+
+def decode(pages=50):
+    from quickbooks import JSONCodec
+
+    rnd = random.Random(1)
+    bodies = [query_page(rnd, 1 + 500 * n) for n in range(pages)]
+    total_mb = sum(len(body) for body in bodies) / 1048576.0
+
+    print "%d pages of 500 invoices, %.1f MB" % (pages, total_mb)
+    codecs = [JSONCodec(json)]
+    for name in JSONCodec._preferred:
+        try:
+            codecs.append(JSONCodec(name))
+        except ImportError:
+            print "  (%s not installed)" % name
+
+    baseline = None
+    for codec in codecs:
+        start = time.time()
+        for body in bodies:
+            codec.loads(body)
+
+        elapsed = time.time() - start
+        baseline = baseline or elapsed
+        print "  %-10s %7.1f pages/s %7.1f MB/s  %.2fx" % (
+            codec.name, pages / elapsed, total_mb / elapsed, baseline / elapsed)
+
+def customers_document(count):
+    customers = "".join(
+        '<Customer><Id idDomain="QBO">%d</Id><Name>Customer %d</Name><Active>true</Active>'
+        '<Address><Line1>%d Main St</Line1><City>Springfield</City></Address>'
+        '<Phone><FreeFormNumber>555-%04d</FreeFormNumber></Phone></Customer>' % (i, i, i, i % 10000)
+        for i in xrange(count))
+
+    return ('<qbo:SearchResults xmlns="http://www.intuit.com/sb/cdm/v2" xmlns:qbo="http://www.intuit.com/sb/cdm/qbo">'
+        '<qbo:CdmCollections>%s</qbo:CdmCollections><qbo:Count>%d</qbo:Count></qbo:SearchResults>' % (customers, count))
+
+def xml(count=20000):
+    import cStringIO
+    from quickbooks import _iter_xml, ET
+
+    document = customers_document(count)
+    print "%d customers, %.1f MB" % (count, len(document) / 1048576.0)
+
+    timings = []
+    try:
+        import xmltodict
+
+        start = time.time()
+        root = ET.fromstring(document)
+        baseline = [xmltodict.parse(ET.tostring(customer)) for customer in root.iter("{http://www.intuit.com/sb/cdm/v2}Customer")]
+        timings.append(("old", time.time() - start, len(baseline)))
+    except ImportError:
+        baseline = None
+        print "  (xmltodict not installed, no baseline)"
+
+    start = time.time()
+    customers = [value for name, value in _iter_xml(cStringIO.StringIO(document), ("Customer",), ("Customer",)) if name == "Customer"]
+    timings.append(("iterparse", time.time() - start, len(customers)))
+
+    if baseline is not None and customers != baseline:
+        raise Exception("iterparse customers differ from the baseline")
+
+    for label, elapsed, found in timings:
+        print "  %-10s %6.2f s  %8.0f customers/s  %.2fx" % (label, elapsed, found / elapsed, timings[0][1] / elapsed)
+
+def synthetic_entity(qbbo, i, rnd, lines=None):
+    if qbbo == "Invoice":
+        return synthetic_invoice(i, rnd, lines)
+
+    return {
+        "Id": str(i), "SyncToken": "0", "domain": "QBO", "sparse": False, "Active": True,
+        "Name": "%s %d" % (qbbo, i), "DisplayName": "%s %d" % (qbbo, i),
+        "MetaData": {"CreateTime": "2015-01-01T10:00:00-08:00", "LastUpdatedTime": "2015-01-02T10:00:00-08:00"}}
+
+class MockQBO():
+    """
+    A local stand-in for the QBO v3 API, good enough to benchmark against:
+    queries (paged, COUNT(*), Attachables by Id), CRUD, batch, cdc,
+    reports, uploads, download links and the files behind them (with
+    Range requests).
+
+    Every type has records synthetic entities (invoices with lines Lines
+    each, if given), files are file_size bytes. Each request (but file
+    downloads) waits latency seconds, and fails with probability
+    fault_rate, with a Fault (500 SystemFault), a 429 ThrottleExceeded or
+    a 503, picked from faults.
+    """
+
+    def __init__(self, records=5000, lines=None, latency=0.0, fault_rate=0.0, faults=("Fault", "429", "503"),
+            file_size=1 << 20, seed=1):
+        import quickbooks
+
+        self.records = records
+        self.lines = lines
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.faults = faults
+        self.file_size = file_size
+        self.rnd = random.Random(seed)
+        self.names = dict((name.lower(), name) for name in quickbooks.QuickBooks()._business_objects)
+        self.names["attachable"] = "Attachable"
+
+        self._lock = threading.Lock()
+        self._entities = {}
+        self._pages = {}
+        self._file = None
+        self._next_id = [10 ** 6]
+        self.requests = 0
+        self.faults_sent = 0
+
+        mock = self
+        class Handler(MockHandler):
+            pass
+
+        Handler.mock = mock
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server.server_port
+
+    @property
+    def base_url_v3(self):
+        return self.url + "/v3"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def entities(self, qbbo):
+        with self._lock:
+            if qbbo not in self._entities:
+                self._entities[qbbo] = [synthetic_entity(qbbo, i, self.rnd, self.lines) for i in xrange(1, self.records + 1)]
+
+            return self._entities[qbbo]
+
+    def query_page(self, qbbo, start, size, fields=None):
+        """
+        A serialized QueryResponse page (of just fields, if given), made once.
+        """
+
+        key = (qbbo, start, size, fields)
+        if key not in self._pages:
+            page = self.entities(qbbo)[start - 1:start - 1 + size]
+            if fields:
+                page = [dict((field, entity[field]) for field in fields if field in entity) for entity in page]
+
+            body = {"QueryResponse": {qbbo: page, "startPosition": start, "maxResults": len(page)} if page else {},
+                "time": "2015-01-01T10:00:00.000-08:00"}
+            self._pages[key] = json.dumps(body)
+
+        return self._pages[key]
+
+    def new_id(self):
+        with self._lock:
+            self._next_id[0] += 1
+            return str(self._next_id[0])
+
+    def file_bytes(self):
+        if self._file is None:
+            self._file = "".join(chr(i % 256) for i in xrange(65536)) * (self.file_size // 65536 + 1)
+            self._file = self._file[:self.file_size]
+
+        return self._file
+
+    def fault(self):
+        """
+        Which fault (if any) to answer the next request with.
+        """
+
+        with self._lock:
+            self.requests += 1
+            if self.fault_rate and self.rnd.random() < self.fault_rate:
+                self.faults_sent += 1
+                return self.rnd.choice(self.faults)
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    #one write per response, and no Nagle, or every request waits out a delayed ACK
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, content_type="application/json", headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        mock = self.mock
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if url.path.startswith("/files/"):
+            return self.send_file()
+
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        fault = mock.fault()
+        if fault == "Fault":
+            return self.reply(500, json.dumps({"Fault": {"type": "SystemFault", "Error": [{"Message": "injected"}]}}))
+        elif fault == "429":
+            return self.reply(429, json.dumps({"Fault": {"type": "ThrottleExceeded"}}), headers={"Retry-After": "0"})
+        elif fault == "503":
+            return self.reply(503, "<html>Service Unavailable</html>", "text/html")
+
+        match = re.match(r"/v3/company/[^/]+/(.+)$", url.path)
+        route = match.group(1) if match else ""
+        if route == "query":
+            return self.query(body if method == "POST" else params.get("query", ""))
+        elif route == "batch":
+            return self.batch(json.loads(body))
+        elif route == "cdc":
+            return self.reply(200, json.dumps({"CDCResponse": [{"QueryResponse": []}], "time": "2015-01-01T10:00:00.000-08:00"}))
+        elif route == "upload":
+            return self.reply(200, json.dumps({"AttachableResponse": [{"Attachable": {
+                "Id": mock.new_id(), "SyncToken": "0", "Size": len(body)}}]}))
+        elif route.startswith("download/"):
+            return self.reply(200, "%s/files/%s" % (mock.url, route.split("/")[1]), "text/plain")
+        elif route.startswith("reports/"):
+            return self.report(route.split("/")[1], params)
+
+        parts = route.split("/")
+        qbbo = mock.names.get(parts[0])
+        if qbbo is None:
+            return self.reply(404, json.dumps({"Fault": {"type": "ValidationFault", "Error": [{"Message": "no such route"}]}}))
+
+        if method == "GET":
+            Id = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+            entities = mock.entities(qbbo)
+            entity = entities[(Id - 1) % len(entities)]
+            return self.reply(200, json.dumps({qbbo: entity, "time": "2015-01-01T10:00:00.000-08:00"}))
+
+        entity = json.loads(body)
+        if params.get("operation") == "delete":
+            entity = {"Id": entity.get("Id"), "status": "Deleted", "domain": "QBO"}
+        else:
+            entity.setdefault("Id", mock.new_id())
+            entity["SyncToken"] = str(int(entity.get("SyncToken", -1)) + 1)
+
+        self.reply(200, json.dumps({qbbo: entity, "time": "2015-01-01T10:00:00.000-08:00"}))
+
+    def query(self, query):
+        mock = self.mock
+        match = re.search(r"(?i)SELECT\s+(.+?)\s+FROM\s+(\w+)", query)
+        if not match:
+            return self.reply(400, json.dumps({"Fault": {"type": "ValidationFault", "Error": [{"Message": "bad query"}]}}))
+
+        qbbo = match.group(2)
+        if match.group(1).upper() == "COUNT(*)":
+            return self.reply(200, json.dumps({"QueryResponse": {"totalCount": mock.records}}))
+
+        if qbbo == "Attachable":
+            ids = re.findall(r"'(\w+)'", query)
+            rows = [{"Id": Id, "FileName": "file%s.bin" % Id, "Size": float(mock.file_size),
+                "TempDownloadUri": "%s/files/%s" % (mock.url, Id)} for Id in ids]
+            return self.reply(200, json.dumps({"QueryResponse": {"Attachable": rows} if rows else {}}))
+
+        start = re.search(r"(?i)STARTPOSITION\s+(\d+)", query)
+        size = re.search(r"(?i)MAXRESULTS\s+(\d+)", query)
+        fields = None if match.group(1) == "*" else tuple(field.strip() for field in match.group(1).split(","))
+        self.reply(200, mock.query_page(qbbo, int(start.group(1)) if start else 1, int(size.group(1)) if size else 100, fields))
+
+    def batch(self, request):
+        responses = []
+        for item in request["BatchItemRequest"]:
+            qbbo = [key for key in item if key not in ("bId", "operation")][0]
+            entity = dict(item[qbbo])
+            entity.setdefault("Id", self.mock.new_id())
+            entity["SyncToken"] = str(int(entity.get("SyncToken", -1)) + 1)
+            responses.append({"bId": item["bId"], qbbo: entity})
+
+        self.reply(200, json.dumps({"BatchItemResponse": responses, "time": "2015-01-01T10:00:00.000-08:00"}))
+
+    def report(self, name, params):
+        rows = [{"ColData": [{"value": "2015-01-%02d" % (i % 28 + 1)}, {"value": "Invoice"}, {"value": str(1000 + i)},
+            {"value": "Customer %d" % (i % 50)}, {"value": "%.2f" % (i * 1.5)}]} for i in xrange(self.mock.records // 10)]
+
+        self.reply(200, json.dumps({
+            "Header": {"ReportName": name, "StartPeriod": params.get("start_date"), "EndPeriod": params.get("end_date")},
+            "Columns": {"Column": [{"ColTitle": title, "ColType": kind} for title, kind in (("Date", "tx_date"),
+                ("Transaction Type", "txn_type"), ("Num", "doc_num"), ("Name", "name"), ("Amount", "subt_nat_amount"))]},
+            "Rows": {"Row": rows}}))
+
+    def send_file(self):
+        data = self.mock.file_bytes()
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+
+        self.reply(206 if start else 200, data[start:], "application/octet-stream")
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def _scenario(name, config):
+    """
+    Runs one scenario against a MockQBO at config["url"], returns its
+    numbers. Runs in a child process, see suite.
+    """
+
+    import quickbooks
+
+    requests = []
+    retries = [0]
+    def collect(event):
+        if event["event"] == "request":
+            requests.append((sum(event.get(phase, 0) for phase in quickbooks.Metrics.phases),
+                event["bytes_sent"] + event["bytes_received"]))
+        elif event["event"] == "retry":
+            retries[0] += 1
+
+    client_args = dict(consumer_key="bench", consumer_secret="bench", access_token="bench", access_token_secret="bench",
+        company_id=1, rate_limit=config["rate"], concurrency=config["concurrency"], backoff_base=0.01, backoff_cap=0.1,
+        metrics=None, hooks=[collect])
+    client_args.update(config.get("client", {}))
+    qb = quickbooks.QuickBooks(**client_args)
+    qb.base_url_v3 = config["url"] + "/v3"
+
+    ops = config["ops"]
+    transferred = 0
+    started = time.time()
+    if name in ("query_fetch_more", "query_fetch_more_parallel"):
+        items = len(qb.query_fetch_more("POST", True, qb.company_id, "Invoice", "SELECT * FROM Invoice",
+            parallel=name.endswith("parallel")))
+    elif name in ("get_objects", "get_objects_compact"):
+        items = len(qb.get_objects("Invoice"))
+    elif name == "get_objects_projected":
+        items = len(qb.get_objects("Invoice", fields=["DocNumber", "TxnDate", "CustomerRef", "TotalAmt", "Balance"]))
+    elif name in ("names", "names_serial"):
+        lists = qb.object_dicts(qb._name_list_objects, parallel=name == "names")
+        items = sum(len(objects) for objects in lists.values())
+    elif name == "crud":
+        items = 0
+        for i in xrange(ops):
+            created = qb.create_object("Customer", json.dumps({"DisplayName": "Bench %d" % i}))
+            read = qb.read_object("Customer", created["Id"])
+            qb.update_object("Customer", created["Id"], dict(read, DisplayName="Bench %d updated" % i))
+            qb.delete_object("Customer", json_dict={"Id": created["Id"], "SyncToken": "1"})
+            items += 4
+    elif name == "sparse_updates":
+        #an edit made on a cached entity (or a read, with or without the
+        #read cache) still has to go out; raises if one gets dropped
+        items = 0
+        customers = qb.get_objects("Customer")
+        for read_cache in (qb.read_cache, None):
+            qb.read_cache = read_cache
+            for Id in sorted(customers)[:ops]:
+                for source in ("list", "read"):
+                    entity = customers[Id] if source == "list" else qb.read_object("Customer", Id)
+                    entity["DisplayName"] = "Bench %s %d" % (Id, items)
+                    sent = len(requests)
+                    qb.update_object("Customer", Id, entity, sparse=True)
+                    if len(requests) == sent:
+                        raise Exception("Update of Customer %s was never sent." % Id)
+
+                    items += 1
+    elif name == "batch":
+        with qb.batch() as batch:
+            for i in xrange(ops * 30):
+                batch.create("Customer", {"DisplayName": "Bench %d" % i})
+
+        items = ops * 30
+    elif name == "report":
+        items = 0
+        for i in xrange(ops):
+            items += len(qb.get_report("TransactionList", {"start_date": "2015-01-01", "end_date": "2015-12-31"})["Rows"]["Row"])
+    elif name == "report_table":
+        table = qb.report_table("TransactionList", "2013-01-01", "2015-12-31", "month")
+        items = len(table)
+        table.sum("Amount", by="period_start")
+    elif name == "upload":
+        directory = tempfile.mkdtemp()
+        paths = []
+        for i in xrange(ops):
+            paths.append(os.path.join(directory, "upload%d.bin" % i))
+            with open(paths[-1], "wb") as f:
+                f.write(os.urandom(config["file_size"]))
+
+        started = time.time()
+        items = len(qb.upload_files(paths))
+        transferred = ops * config["file_size"]
+    elif name == "download":
+        directory = tempfile.mkdtemp()
+        items = len(qb.download_files([str(i) for i in xrange(1, ops + 1)], dest=directory))
+        transferred = ops * config["file_size"]
+    else:
+        raise Exception("No such scenario: %s" % name)
+
+    elapsed = time.time() - started
+    latencies = [latency for latency, size in requests]
+    transferred = transferred or sum(size for latency, size in requests)
+    return {"scenario": name, "items": items, "seconds": elapsed, "requests": len(requests), "retries": retries[0],
+        "items_per_s": items / elapsed, "requests_per_s": len(requests) / elapsed, "mb_per_s": transferred / 1048576.0 / elapsed,
+        "p50_ms": 1000 * percentile(latencies, 0.5), "p95_ms": 1000 * percentile(latencies, 0.95),
+        "p99_ms": 1000 * percentile(latencies, 0.99), "peak_mb": peak_rss_kb() / 1024.0}
+
+scenarios = ("query_fetch_more", "query_fetch_more_parallel", "get_objects", "get_objects_compact", "get_objects_projected",
+    "names_serial", "names", "crud", "sparse_updates", "batch",
+    "report", "report_table", "upload", "download")
+
+def suite(argv):
+    parser = argparse.ArgumentParser(prog="bench.py suite", description="Benchmarks quickbooks.py against MockQBO.")
+    parser.add_argument("scenarios", nargs="*", default=scenarios, help="any of: %s (default all)" % ", ".join(scenarios))
+    parser.add_argument("--records", type=int, default=5000, help="entities per type (default 5000)")
+    parser.add_argument("--lines", type=int, default=None, help="Lines per invoice (default 1-6)")
+    parser.add_argument("--ops", type=int, default=20, help="operations for crud/batch/report/upload/download (default 20)")
+    parser.add_argument("--file-size", type=int, default=1 << 20, help="attachment size in bytes (default 1 MB)")
+    parser.add_argument("--latency", type=float, default=0.0, help="server latency per request in seconds")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="share of requests that fail (default 0)")
+    parser.add_argument("--faults", default="Fault,429,503", help="which faults to inject (default Fault,429,503)")
+    parser.add_argument("--rate", type=float, default=1000.0, help="client rate limit, requests/s (default 1000, i.e. none)")
+    parser.add_argument("--concurrency", type=int, default=10, help="client concurrency limit (default 10)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON lines")
+    options = parser.parse_args(argv)
+
+    mock = MockQBO(records=options.records, lines=options.lines, latency=options.latency, fault_rate=options.fault_rate,
+        faults=tuple(options.faults.split(",")), file_size=options.file_size).start()
+
+    #so the first scenario doesn't pay for making up the invoices
+    mock.entities("Invoice")
+
+    if not options.json:
+        print "%d records/type, latency %.0f ms, fault rate %.1f%%, rate limit %g/s" % (
+            options.records, 1000 * options.latency, 100 * options.fault_rate, options.rate)
+        print "%-26s %8s %9s %9s %8s %8s %8s %8s %7s %8s" % (
+            "scenario", "items", "items/s", "req/s", "MB/s", "p50 ms", "p95 ms", "p99 ms", "retries", "peak MB")
+
+    try:
+        for name in options.scenarios:
+            config = {"url": mock.url, "records": options.records, "ops": options.ops, "file_size": options.file_size,
+                "rate": options.rate, "concurrency": options.concurrency,
+                "client": {"compact": True} if name.endswith("compact") else {}}
+            if name == "sparse_updates":
+                config["client"]["read_cache_size"] = 1000
+            out = subprocess.check_output([sys.executable, __file__, "_scenario", name, json.dumps(config)])
+            result = json.loads(out.strip().splitlines()[-1])
+            if options.json:
+                print json.dumps(result)
+            else:
+                print "%-26s %8d %9.1f %9.1f %8.1f %8.1f %8.1f %8.1f %7d %8.1f" % (name, result["items"], result["items_per_s"],
+                    result["requests_per_s"], result["mb_per_s"], result["p50_ms"], result["p95_ms"], result["p99_ms"],
+                    result["retries"], result["peak_mb"])
+    finally:
+        mock.stop()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "_memory":
+        memory_child(sys.argv[2], int(sys.argv[3]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "memory":
+        memory(*[int(a) for a in sys.argv[2:3]])
+    elif len(sys.argv) > 1 and sys.argv[1] == "decode":
+        decode(*[int(a) for a in sys.argv[2:3]])
+    elif len(sys.argv) > 1 and sys.argv[1] == "xml":
+        xml(*[int(a) for a in sys.argv[2:3]])
+    elif len(sys.argv) > 1 and sys.argv[1] == "_scenario":
+        print json.dumps(_scenario(sys.argv[2], json.loads(sys.argv[3])))
+    elif len(sys.argv) > 1 and sys.argv[1] == "suite":
+        suite(sys.argv[2:])
+    else:
+        print __doc__
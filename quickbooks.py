@@ -1,11 +1,239 @@
 from rauth import OAuth1Session, OAuth1Service
-import xml.etree.ElementTree as ET
-import xmltodict
-from xml.dom import minidom
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+import xml.etree.ElementTree as _ElementTree
 import requests, urllib
-import json, time
-import textwrap
+import requests.adapters
+import json, time, re, random, math
+import collections, bisect
+import threading, Queue
+import os, mimetypes
+import gzip
+import uuid
+import cStringIO
 import datetime
+import sqlite3
+import array
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _iter_xml(source, record_tags=(), detached=()):
+    """
+    Parses an XML document (a file-like object) in one pass with iterparse,
+    building xmltodict-style dicts ("@attr", "#text", repeated tags become
+    lists) as it goes, so nothing gets parsed twice.
+
+    Yields (local name, value) for every element whose local name is in
+    record_tags as soon as it's complete; those are left out of the rest
+    of the document, so memory stays bounded by the largest record.
+    Finally yields (root name, value) for what's left of the document.
+
+    A record whose local name is also in detached comes out the way
+    xmltodict.parse(ET.tostring(record)) would have it: as a document of
+    its own, {"ns0:Customer": {"@xmlns:ns0": ..., "ns0:Id": ...}}, with
+    the prefixes ElementTree makes up rather than the document's.
+    """
+
+    prefixes = {}
+    declared = []
+    stack = []
+    #(depth, {uri: prefix}) of the detached record we're in, if any
+    record = [None]
+
+    def qualified(tag):
+        # "{uri}local" back to "prefix:local", like the document (or
+        # ElementTree, in a detached record) has it
+        if tag[0] != "{":
+            return tag, tag
+
+        uri, local = tag[1:].split("}", 1)
+        if record[0] is None:
+            prefix = prefixes.get(uri)
+        else:
+            namespaces = record[0][1]
+            prefix = namespaces.get(uri)
+            if prefix is None:
+                #numbered the same way ElementTree's serializer does it
+                prefix = _ElementTree._namespace_map.get(uri) or "ns%d" % len(namespaces)
+                if prefix != "xml":
+                    namespaces[uri] = prefix
+
+        return ("%s:%s" % (prefix, local) if prefix else local), local
+
+    for event, item in ET.iterparse(source, events=("start-ns", "start", "end")):
+        if event == "start-ns":
+            prefix, uri = item
+            prefixes.setdefault(uri, prefix)
+            declared.append((("@xmlns:" + prefix) if prefix else "@xmlns", uri))
+            continue
+
+        if event == "start" and record[0] is None and item.tag.rsplit("}", 1)[-1] in detached:
+            record[0] = (len(stack), {})
+
+        name, local = qualified(item.tag)
+        if event == "start":
+            #a detached record doesn't keep the document's declarations
+            value = dict(declared) if record[0] is None else {}
+            del declared[:]
+            for key, attr in item.attrib.iteritems():
+                value["@" + qualified(key)[0]] = attr
+
+            stack.append(value)
+            continue
+
+        value = stack.pop()
+        record_end = record[0] is not None and len(stack) == record[0][0]
+        if record_end:
+            for uri, prefix in record[0][1].iteritems():
+                value["@xmlns:" + prefix] = uri
+
+        text = item.text.strip() if item.text else None
+        if not value:
+            value = text or None
+        elif text:
+            value["#text"] = text
+
+        item.clear()
+        if record_end:
+            record[0] = None
+            yield local, {name: value}
+        elif local in record_tags and record[0] is None:
+            yield local, value
+        elif not stack:
+            yield name, value
+        else:
+            parent = stack[-1]
+            if name not in parent:
+                parent[name] = value
+            elif isinstance(parent[name], list) and not name.startswith("@"):
+                parent[name].append(value)
+            else:
+                parent[name] = [parent[name], value]
+
+def _xml_to_dict(source):
+    """
+    A whole XML document as a dict, see _iter_xml.
+    """
+
+    for name, value in _iter_xml(source):
+        pass
+
+    return {name: value}
+
+def _xml_source(resp):
+    """
+    What to parse a response's XML from: a streamed (stream=True) response
+    gets parsed as it comes off the wire, anything else from its content.
+    """
+
+    if resp._content is False:
+        resp.raw.decode_content = True
+        return resp.raw
+
+    return cStringIO.StringIO(resp.content)
+
+def _entity_type(url, req_kwargs, known=()):
+    """
+    Which entity (or report etc.) a request is about, for request events:
+    the FROM of a query, otherwise what the URL's named after (spelled
+    like in known, e.g. "invoice" -> "Invoice").
+    """
+
+    if "/query" in url:
+        query = req_kwargs.get("data") or (req_kwargs.get("params") or {}).get("query") or ""
+        match = re.search(r"\bFROM\s+(\w+)", query if isinstance(query, basestring) else "", re.I)
+        if match:
+            return match.group(1)
+
+    match = re.search(r"/company/[^/]+/(\w+)(?:/(\w+))?", url) or re.search(r"/resource/([\w-]+)/v2", url)
+    if not match:
+        return None
+
+    if match.group(1) == "reports" and match.lastindex > 1:
+        return match.group(2)
+
+    for name in known:
+        if name.lower() == match.group(1):
+            return name
+
+    return match.group(1)
+
+def _body_size(body):
+    if body is None:
+        return 0
+
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+def _received_size(resp):
+    """
+    Bytes off the wire for a response (before any decompression).
+    """
+
+    try:
+        return resp.raw.tell()
+    except AttributeError:
+        return len(resp.content or "")
+
+def _before_sending(error):
+    """
+    Whether a requests error happened while connecting, i.e. before any of
+    the request went out (so even a create can safely be sent again).
+    """
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+
+    if isinstance(error, requests.ConnectionError) and error.args:
+        reason = getattr(error.args[0], "reason", error.args[0])
+        return type(reason).__name__ == "NewConnectionError"
+
+    return False
+
+def _field_values(obj, field):
+    """
+    The values at a dotted field path in an entity, as a list: several for
+    "Line." paths (one per line that has it, looking in the line's detail
+    when it's not on the line itself), otherwise none or one. Refs give
+    their value (Id) unless you ask for ".name".
+    """
+
+    if field.startswith("Line."):
+        path = field[5:].split(".")
+        objs = []
+        #peek, so indexing a CompactEntity doesn't leave its Line decoded
+        lines = obj.peek("Line", []) if isinstance(obj, CompactEntity) else obj.get("Line", [])
+        for line in lines:
+            if path[0] not in line and line.get("DetailType") in line:
+                line = line[line["DetailType"]]
+
+            objs.append(line)
+    else:
+        path = field.split(".")
+        objs = [obj]
+
+    values = []
+    for value in objs:
+        for key in path:
+            if not isinstance(value, _mapping_types) or key not in value:
+                break
+
+            value = value[key]
+        else:
+            if isinstance(value, _mapping_types) and "value" in value:
+                value = value["value"]
+
+            values.append(value)
+
+    return values
 
 class QuickBooks():
     """
@@ -17,7 +245,46 @@ class QuickBooks():
     request_token_url = "https://oauth.intuit.com/oauth/v1/get_request_token"
     access_token_url = "https://oauth.intuit.com/oauth/v1/get_access_token"
     authorize_url = "https://appcenter.intuit.com/Connect/Begin"
+    reconnect_url = "https://appcenter.intuit.com/api/v1/connection/reconnect"
     _attemps_count = 5
+
+    # OAuth 1.0a access tokens are good for 180 days
+    _token_lifetime_days = 180
+
+    # Read size for attachment downloads
+    _download_chunk_size = 1024 * 1024
+
+    # The maximum number of results returned by QB per query page
+    _max_results = 500
+
+    # How far back the Change Data Capture endpoint looks, and the most
+    # changed entities of one type it returns before cutting the list off
+    _cdc_window_days = 30
+    _cdc_max_changes = 1000
+    _all_names_tail = "WHERE Active IN (true,false)"
+
+    #what a sparse update never sends (QB sets these), see _sparse_update
+    _read_only_fields = ["MetaData", "domain", "sparse", "time"]
+
+    _default_indexes = {
+        "Account": ["Name", "FullyQualifiedName"],
+        "Class": ["Name", "FullyQualifiedName"],
+        "Customer": ["DisplayName", "FullyQualifiedName"],
+        "Department": ["Name", "FullyQualifiedName"],
+        "Employee": ["DisplayName"],
+        "Item": ["Name", "FullyQualifiedName"],
+        "Vendor": ["DisplayName"],
+        "Invoice": ["CustomerRef"],
+        "Bill": ["VendorRef", "Line.ClassRef", "Line.AccountRef"],
+        "Purchase": ["Line.CustomerRef", "Line.ClassRef", "Line.AccountRef"],
+        "JournalEntry": ["Line.ClassRef", "Line.AccountRef"],
+    }
+    _default_sorted_indexes = {
+        "Invoice": ["TxnDate"],
+        "Bill": ["TxnDate"],
+        "Purchase": ["TxnDate"],
+        "JournalEntry": ["TxnDate"],
+    }
     _namespace = "http://platform.intuit.com/api/v1"
 
     def __init__(self, **args):
@@ -44,6 +311,52 @@ class QuickBooks():
         self.company_id = args.get("company_id", 0)
         self.verbosity = args.get("verbosity", 0)
 
+        #request event hooks (see _emit) and the metrics registry they feed
+        self.metrics = args.get("metrics", default_metrics)
+        self.hooks = list(args.get("hooks", []))
+        if self.metrics is not None:
+            self.hooks.insert(0, self.metrics.record)
+
+        self.hooks.append(self._print_event)
+
+        #send updates as sparse ones where we can, see update_object
+        self.sparse_updates = args.get("sparse_updates", False)
+
+        #keep cached/queried entities as CompactEntity records instead of dicts
+        self.compact = args.get("compact", False)
+
+        #optional on-disk entity cache, see EntityCache
+        self.cache = args.get("cache", None)
+        if self.cache is None and args.get("cache_path"):
+            self.cache = EntityCache(args["cache_path"], ttl=args.get("cache_ttl"), max_entries=args.get("cache_size"))
+
+        #in-memory LRU in front of single-entity reads, if asked for, see ReadCache
+        self.read_cache = args.get("read_cache", None)
+        if self.read_cache is None and args.get("read_cache_size"):
+            self.read_cache = ReadCache(args["read_cache_size"], args.get("read_cache_ttl", 60))
+
+        #transport settings, see _request
+        self.pool_size = args.get("pool_size", 10)
+        self.http_adapter = args.get("http_adapter", None)
+        self.timeout = args.get("timeout", (10, 120))
+        self.verify = args.get("verify", True)
+        self.max_tries = args.get("max_tries", 10)
+        self.auth_tries = args.get("auth_tries", 15)
+        self._reconnect_lock = threading.RLock()
+
+        #every instance for a realm shares that realm's limiter, see RateLimiter
+        self.rate_limiter = args.get("rate_limiter", None) or RateLimiter.for_realm(self.company_id, args.get("rate_limit"),
+            concurrency=args.get("concurrency")
+        )
+        self.backoff_base = args.get("backoff_base", 1.0)
+        self.backoff_cap = args.get("backoff_cap", 30.0)
+
+        self.parallel_queries = args.get("parallel_queries", False)
+        self.query_workers = args.get("query_workers", 4)
+        self.query_pool = args.get("query_pool", None)
+        self._own_query_pool = self.query_pool is None
+        self._query_pool_lock = threading.Lock()
+
         self._business_objects = ["Account","Attachable","Bill","BillPayment", "Class","CompanyInfo","CreditMemo","Customer",
             "Department","Employee","Estimate","Invoice", "Item","JournalEntry","Payment","PaymentMethod", "Preferences",
             "Purchase","PurchaseOrder", "SalesReceipt","TaxCode","TaxRate","Term", "TimeActivity","Vendor","VendorCredit"
@@ -53,61 +366,373 @@ class QuickBooks():
             "TaxRate", "Term", "Vendor"
         ]
 
+        self._cdc_objects = ["Account", "Bill", "BillPayment", "Class", "CreditMemo", "Customer", "Department",
+            "Employee", "Estimate", "Invoice", "Item", "JournalEntry", "Payment", "PaymentMethod", "Purchase",
+            "PurchaseOrder", "SalesReceipt", "Term", "TimeActivity", "Vendor", "VendorCredit"
+        ]
+
+        #when each cached <Qbbo>s dict was last pulled or synced (UTC)
+        self._last_sync = {}
+
+        #how many entities the <Qbbo>s dicts hold, kept as they change (so
+        #far as it's through the client), and who to tell (see QuickBooksPool)
+        self._cached_count = 0
+        self.on_cache_change = args.get("on_cache_change", None)
+
+        #secondary indexes on the <Qbbo>s dicts: {qbbo: [field, ...]} for hash
+        #indexes, plus {qbbo: [field, ...]} for sorted ones, see add_index
+        self._indexes = {}
+        for qbbo, fields in args.get("indexes", self._default_indexes).iteritems():
+            for field in fields:
+                self.add_index(qbbo, field)
+
+        for qbbo, fields in args.get("sorted_indexes", self._default_sorted_indexes).iteritems():
+            for field in fields:
+                self.add_index(qbbo, field, sorted=True)
+
         self._transaction_objects = ["Bill", "BillPayment", "CreditMemo", "Estimate", "Invoice", "JournalEntry", "Payment", "Purchase", 
             "PurchaseOrder", "SalesReceipt", "TimeActivity", "VendorCredit"
         ]
 
     def _reconnect_by_demand(self):
-        current_date = datetime.date.today()
-        days_diff = (self.expire_date - current_date).days
-        if days_diff > 0:
-            if days_diff <= self.reconnect_window_days_count:
-                print "Going to reconnect..."
-                if self._reconnect():
-                    print "Reconnected successfully"
-                else:    
-                    print "Unable to reconnect, try again later, you have {} days left to do that".format(days_diff - self.reconnect_window_days_count)
-        else:
-            raise "The token is expired, unable to reconnect, please get a new one."
+        if not self.expire_date or not self.reconnect_window_days_count:
+            return
+
+        with self._reconnect_lock:
+            current_date = datetime.date.today()
+            days_diff = (self.expire_date - current_date).days
+            if days_diff > 0:
+                if days_diff <= self.reconnect_window_days_count:
+                    print "Going to reconnect..."
+                    if self._reconnect():
+                        print "Reconnected successfully"
+                    else:    
+                        print "Unable to reconnect, try again later, you have {} days left to do that".format(days_diff - self.reconnect_window_days_count)
+            else:
+                raise Exception("The token is expired, unable to reconnect, please get a new one.")
 
     def _reconnect(self, i=1):
         if i > self._attemps_count:
             print "Unable to reconnect, there're no attempts left ({} attempts sent).".format(i)
             return False
         else:
-            self._create_session_by_demand()
-            resp = self.session.request("GET", "https://appcenter.intuit.com/api/v1/connection/reconnect", True, self.company_id, verify=False)
-            dom = minidom.parseString(ET.tostring(ET.fromstring(resp.content), "utf-8"))
-            if resp.status_code == 200:
-                error_code = int(dom.getElementsByTagNameNS(self._namespace, "ErrorCode")[0].firstChild.nodeValue)
+            result = self._request("GET", self.reconnect_url, "xml", reconnect=False, stream=True)
+            if isinstance(result, dict) and "ReconnectResponse" in result:
+                response = result["ReconnectResponse"]
+                error_code = int(response["ErrorCode"])
                 if error_code == 0:
                     print "Reconnected successfully"
 
-                    date_raw  = dom.getElementsByTagNameNS(self._namespace, "ServerTime")[0].firstChild.nodeValue
                     from dateutil import parser
-                    self.added_at = parser.parse(date_raw).date()
-                    
-                    self.access_token = str(dom.getElementsByTagNameNS(self._namespace, "OAuthToken")[0].firstChild.nodeValue)
-                    self.access_token_secret = str(dom.getElementsByTagNameNS(self._namespace, "OAuthTokenSecret")[0].firstChild.nodeValue)
+                    self.added_at = parser.parse(response["ServerTime"]).date()
+                    self.expire_date = self.added_at + datetime.timedelta(days=self._token_lifetime_days)
+
+                    self.access_token = str(response["OAuthToken"])
+                    self.access_token_secret = str(response["OAuthTokenSecret"])
+                    self.session.access_token = self.access_token
+                    self.session.access_token_secret = self.access_token_secret
                     if self.acc_token_changed_callback:
                         self.acc_token_changed_callback(self.added_at, self.access_token, self.access_token_secret)
 
                     return True
                 else:
-                    msg = str(dom.getElementsByTagNameNS(self._namespace, "ErrorMessage")[0].firstChild.nodeValue)
+                    msg = str(response["ErrorMessage"])
                     print "An error occurred while trying to reconnect, code: {}, message: \"{}\"".format(error_code, msg)
                     i += 1
                     print "Trying to reconnect again... attempt #{}".format(i)
-                    self._reconnect(i)
+                    self._backoff(i)
+                    return self._reconnect(i)
             else:
-                print "An HTTP error {} occurred, trying again, attempt #{}".format(resp.status_code, i)
+                print "An unexpected response came back, trying again, attempt #{}".format(i)
                 i += 1
-                self._reconnect(i)
+                self._backoff(i)
+                return self._reconnect(i)
 
     def _create_session_by_demand(self):
         if self.session is None:
             self.create_session()
 
+    def _send(self, request_type, url, header_auth=True, realm=None, oauth=True, timings=None, **req_kwargs):
+        """
+        Every request to QB goes through here: it waits its turn with the
+        realm's rate limiter, and tells the limiter if QB throttled it.
+        oauth=False is for links that aren't QB's (e.g. attachment downloads),
+        those just borrow the pooled session.
+
+        Pass a timings dict to get where the time went, in seconds: queue
+        (waiting on the rate limiter), wait (until the response headers
+        came back, so connecting plus the server's time) and transfer
+        (reading the body; ~0 for stream=True, that happens while parsing).
+        """
+
+        req_kwargs.setdefault("timeout", self.timeout)
+        started = time.time()
+        if not oauth:
+            resp = requests.Session.request(self.session, request_type, url, **req_kwargs)
+            if timings is not None:
+                self._split_timings(timings, resp, started, started, time.time())
+
+            return resp
+
+        self.rate_limiter.acquire()
+        try:
+            sent = time.time()
+            resp = self.session.request(request_type, url, header_auth, realm or self.company_id, **req_kwargs)
+            done = time.time()
+        finally:
+            self.rate_limiter.release()
+
+        if timings is not None:
+            self._split_timings(timings, resp, started, sent, done)
+
+        if resp.status_code == 429 or (resp.status_code >= 400 and "ThrottleExceeded" in resp.content):
+            self._emit("throttled", url=url, status=resp.status_code, retry_after=self._retry_after(resp))
+            self.rate_limiter.throttled(self._retry_after(resp))
+        else:
+            self.rate_limiter.succeeded()
+
+        return resp
+
+    def _split_timings(self, timings, resp, started, sent, done):
+        wait = resp.elapsed.total_seconds() if resp.elapsed else done - sent
+        timings["queue"] = sent - started
+        timings["wait"] = wait
+        timings["transfer"] = max(0.0, done - sent - wait)
+
+    def _retry_after(self, resp):
+        """
+        The Retry-After header of a response in seconds, or None.
+        """
+
+        try:
+            return max(0.0, float(resp.headers["Retry-After"]))
+        except (KeyError, ValueError, TypeError, AttributeError):
+            return None
+
+    def _backoff(self, tries, resp=None):
+        """
+        Sleeps before try #tries: whatever Retry-After the last response asked
+        for, otherwise an exponentially growing, jittered delay.
+        """
+
+        delay = None
+        if resp is not None:
+            delay = self._retry_after(resp)
+
+        if delay is None:
+            ceiling = min(self.backoff_cap, self.backoff_base * 2 ** max(tries - 2, 0))
+            delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+
+        self._emit("backoff", tries=tries, delay=delay)
+        time.sleep(delay)
+
+    def _request(self, request_type, url, accept="json", header_auth=True, realm=None, parse=None, reconnect=True, **req_kwargs):
+        """
+        The one transport everything goes through: the pooled session, the
+        rate limiter and a single retry policy for JSON and XML, v2 and v3.
+        Returns the parsed response (see _decode, or pass your own parse).
+
+        Network errors, 429s, 5xxs and faults are retried up to max_tries
+        times (auth_tries for AUTHENTICATION faults, which QB hands out for
+        no reason all the time); a ValidationFault won't get any better, so
+        it isn't. A fault still there at the end is printed and returned.
+
+        Writes might have gone through even when we never hear back, so v3
+        writes get a requestid (the same on every try), which QB uses to
+        spot and drop a repeat. Other writes (uploads, v2) are only tried
+        again when they can't have gone through: they never got connected,
+        were throttled, or were turned away at the door.
+        """
+
+        self._create_session_by_demand()
+        if parse is None:
+            parse = lambda resp: self._decode(resp, accept)
+
+        entity = _entity_type(url, req_kwargs, self._business_objects)
+        path = url.split("?")[0]
+        repeatable = request_type == "GET" or path.endswith("/query")
+        if not repeatable and url.startswith(self.base_url_v3) and not path.endswith("/upload"):
+            req_kwargs["params"] = dict(req_kwargs.get("params") or {}, requestid=uuid.uuid4().hex)
+            repeatable = True
+
+        tries = 0
+        resp = None
+        while True:
+            tries += 1
+            if tries > 1:
+                #we don"t want to get shut out...
+                self._backoff(tries, resp)
+                self._emit("retry", url=url, entity=entity, tries=tries)
+
+            if reconnect:
+                self._reconnect_by_demand()
+
+            #a streamed body has to start over on every try
+            if hasattr(req_kwargs.get("data"), "rewind"):
+                req_kwargs["data"].rewind()
+
+            timings = {}
+            try:
+                resp = self._send(request_type, url, header_auth, realm, timings=timings, **req_kwargs)
+            except requests.RequestException as e:
+                self._emit("error", method=request_type, url=url, entity=entity, tries=tries, error=e)
+                if tries >= self.max_tries or not (repeatable or _before_sending(e)):
+                    raise
+
+                resp = None
+                continue
+
+            parse_started = time.time()
+            result = parse(resp)
+            timings["parse"] = time.time() - parse_started
+
+            fault = self._fault_type(resp, result)
+            max_tries = self.auth_tries if fault == "AUTHENTICATION" else self.max_tries
+            giving_up = fault == "ValidationFault" or tries >= max_tries
+            if not repeatable and not (resp.status_code == 429 or fault in ("AUTHENTICATION", "ThrottleExceeded")):
+                #it may have gone through anyway
+                giving_up = True
+
+            self._emit("request", method=request_type, url=url, entity=entity, tries=tries,
+                status=resp.status_code, fault=fault, retrying=fault is not None and not giving_up,
+                bytes_sent=_body_size(resp.request.body), bytes_received=_received_size(resp), **timings)
+
+            if fault is None:
+                return result
+
+            if giving_up:
+                self._emit("giving_up", url=url, entity=entity, tries=tries, status=resp.status_code, fault=fault, result=result)
+                return result
+
+    def add_hook(self, hook):
+        """
+        Calls hook(event) for every request event, see _emit. The
+        metrics registry and verbose printing are hooks like any other.
+        """
+
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _emit(self, kind, **event):
+        """
+        Hands a request event (a dict) to the hooks. It always has "event"
+        (kind), "realm" and "time", plus, by kind:
+
+        request: method, url, entity, tries, status, fault (None if it
+            worked), retrying, bytes_sent, bytes_received and timings in
+            seconds: queue, wait, transfer, parse (see _send)
+        error: a network error; method, url, entity, tries, error
+        retry: about to try again; url, entity, tries
+        backoff: sleeping before a retry; tries, delay
+        throttled: QB said slow down; url, status, retry_after
+        giving_up: out of tries (or a fault that won't go away); url,
+            entity, tries, status, fault, result
+        """
+
+        event.update(event=kind, realm=self.company_id, time=time.time())
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                #a broken hook shouldn't take the request down with it
+                print "Request hook %r failed: %s" % (hook, e)
+
+    def _print_event(self, event):
+        """
+        The verbose printing, built on request events (see _emit).
+        """
+
+        kind = event["event"]
+        if kind == "request":
+            if self.verbosity > 6:
+                print "%s %s: HTTP %d in %.3fs (queue %.3f, wait %.3f, transfer %.3f, parse %.3f), %d bytes out, %d in" % (
+                    event["method"], event["entity"] or event["url"], event["status"],
+                    sum(event.get(phase, 0) for phase in ("queue", "wait", "transfer", "parse")),
+                    event.get("queue", 0), event.get("wait", 0), event.get("transfer", 0), event["parse"],
+                    event["bytes_sent"], event["bytes_received"])
+
+            if event["retrying"] and self.verbosity > 4:
+                print "Got a %s fault (HTTP %d), trying again" % (event["fault"], event["status"])
+
+        elif kind == "error" and self.verbosity > 0:
+            print "Request failed: %s" % event["error"]
+
+        elif kind == "backoff" and self.verbosity > 4:
+            print "(waiting %.2fs before retrying)" % event["delay"]
+
+        elif kind == "retry" and self.verbosity > 0:
+            print "(this is try#%d)" % event["tries"]
+
+        elif kind == "throttled" and self.verbosity > 0:
+            print "Throttled by QB (HTTP %d)" % event["status"]
+
+        elif kind == "giving_up":
+            if isinstance(event["result"], dict):
+                print json.dumps(event["result"], indent=1)
+            else:
+                print "Giving up on a %s fault (HTTP %d)" % (event["fault"], event["status"])
+
+    def _decode(self, resp, accept="json"):
+        """
+        Parses a response once, going by its content type: JSON and XML
+        become dicts, anything else (e.g. a file link) stays text.
+        """
+
+        content_type = resp.headers.get("content-type", "")
+        if "json" in content_type:
+            try:
+                return _codec.loads(resp.content)
+            except ValueError:
+                #I've seen, e.g. a ValueError ("No JSON object could be decoded")
+                return {"Fault": {"type": "(inconclusive)"}}
+
+        elif "xml" in content_type:
+            try:
+                return _xml_to_dict(_xml_source(resp))
+            except Exception:
+                return {"Fault": {"type": "(inconclusive)"}}
+
+        return resp.text
+
+    def _fault_type(self, resp, result):
+        """
+        What's wrong with a parsed response, or None if nothing is.
+        """
+
+        if isinstance(result, dict):
+            if "Fault" in result:
+                return result["Fault"].get("type", "(unknown)")
+
+            if "FaultInfo" in result:
+                return "FaultInfo"
+
+            #XML responses come wrapped, e.g. in an IntuitResponse
+            for value in result.values():
+                if isinstance(value, dict) and "Fault" in value:
+                    return value["Fault"].get("@type", "(unknown)")
+
+        elif isinstance(result, basestring):
+            if "Fault" in result:
+                return "(text)"
+
+        elif ET.iselement(result):
+            if result.find("{http://www.intuit.com/sb/cdm/baseexceptionmodel/xsd}ErrorCode") is not None:
+                return "ErrorCode"
+
+        if resp.status_code == 429 or resp.status_code >= 500:
+            return "HTTP %d" % resp.status_code
+
+        return None
+
+    def limiter_state(self):
+        """
+        A snapshot of this realm's rate limiter, see RateLimiter.state.
+        """
+
+        return self.rate_limiter.state()
+
     def get_authorize_url(self):
         """
         Returns the Authorize URL as returned by QB, and specified by OAuth 1.0a. :return URI:
@@ -136,6 +761,16 @@ class QuickBooks():
     def create_session(self):
         if self.consumer_secret and self.consumer_key and self.access_token_secret and self.access_token:
             self.session = OAuth1Session(self.consumer_key, self.consumer_secret, self.access_token, self.access_token_secret)
+
+            #keep-alive connections, pool_size of them per host (unless we're
+            #sharing someone else's, see QuickBooksPool)
+            adapter = self.http_adapter
+            if adapter is None:
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            self.session.verify = self.verify
         else:
             # shouldn"t there be a workflow somewhere to GET the auth tokens?
             # add that or ask someone on oDesk to build it...
@@ -143,57 +778,117 @@ class QuickBooks():
 
         return self.session
 
-    def query_fetch_more(self, r_type, header_auth, realm, qb_object, original_payload=""):
-        """ Wrapper script around keep_trying to fetch more results if there are more. 
+    def _get_query_pool(self):
         """
-        # The maximum number of results returned by QB
-        max_results = 500 
-        start_position = 0
-        more = True
-        data_set = []
+        The worker pool used to fetch query pages concurrently, created the
+        first time it's needed (and shut down by close()).
+        """
+        with self._query_pool_lock:
+            if self.query_pool is None:
+                self.query_pool = ThreadPool(self.query_workers)
+
+        return self.query_pool
+
+    def close(self):
+        """
+        Shuts down the query pool, if this client made one (one passed in
+        as query_pool is left to whoever passed it). The client can still
+        be used afterwards; it'll just make a new pool when it needs one.
+        """
+
+        with self._query_pool_lock:
+            pool, own = self.query_pool, self._own_query_pool
+            if own:
+                self.query_pool = None
+
+        if own and pool is not None:
+            pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _query_page(self, r_type, header_auth, realm, qb_object, original_payload, start_position=1):
+        """
+        Fetches a single STARTPOSITION/MAXRESULTS window of a query and
+        returns the list of records in it.
+        """
+        if start_position > 1:
+            payload = "{} STARTPOSITION {} MAXRESULTS {}".format(original_payload, start_position, self._max_results)
+        else:
+            payload = "{} MAXRESULTS {}".format(original_payload, self._max_results)
+
         url = "{}/company/{}/query".format(self.base_url_v3, self.company_id)
+        r_dict = self.keep_trying(r_type, url, header_auth, realm, payload)
+        if "QueryResponse" not in r_dict:
+            print "FAILED", r_dict
+            r_dict = self.keep_trying(r_type, url, header_auth, realm, payload)
 
-        # Edit the payload to return more results.
-        payload = original_payload + " MAXRESULTS " + str(max_results)
-        while more:
-            r_dict = self.keep_trying(r_type, url, True, self.company_id, payload)
-            try:
-                access = r_dict["QueryResponse"][qb_object]
-            except:
-                if "QueryResponse" in r_dict and r_dict["QueryResponse"] == {}:
-                    return []
-                else:
-                    print "FAILED", r_dict
-                    r_dict = self.keep_trying(r_type, url, True, self.company_id, payload)
+        if self.verbosity > 0:
+            print "(batch begins with record {})".format(start_position)
 
-            # For some reason the totalCount isn"t returned for some queries,
-            # in that case, check the length, even though that actually requires
-            # measuring
-            try:
-                result_count = int(r_dict["QueryResponse"]["totalCount"])
-                if result_count < max_results:
-                    more = False
-            except KeyError:
-                try:
-                    result_count = len(r_dict["QueryResponse"][qb_object])
-                    if result_count < max_results:
-                        more = False
-                except KeyError:
-                    print "\n\n ERROR", r_dict
-                    pass
+        # an empty QueryResponse just means we're past the last record
+        page = r_dict["QueryResponse"].get(qb_object, [])
+        if self.compact:
+            page = [CompactEntity(qb_object, entity) for entity in page]
 
+        return page
 
-            if self.verbosity > 0:
-                print "(batch begins with record {})".format(start_position)
+    def query_count(self, r_type, header_auth, realm, original_payload):
+        """
+        Runs the SELECT COUNT(*) version of a query, returns the number of
+        records the full query would return.
+        """
+        payload = re.sub(r"(?i)^\s*SELECT\s+.+?\s+FROM\s+", "SELECT COUNT(*) FROM ", str(original_payload), 1)
+
+        # ordering means nothing to a count (and QB doesn't like it)
+        payload = re.split(r"(?i)\s+ORDERBY\s+", payload)[0]
+
+        url = "{}/company/{}/query".format(self.base_url_v3, self.company_id)
+        r_dict = self.keep_trying(r_type, url, header_auth, realm, payload)
+        return int(r_dict["QueryResponse"].get("totalCount", 0))
+
+    def query_fetch_more(self, r_type, header_auth, realm, qb_object, original_payload="", parallel=None):
+        """ Wrapper script around keep_trying to fetch more results if there are more.
+        original_payload is a query string or a Query.
+
+        With parallel=True (defaults to the parallel_queries constructor arg)
+        the records are counted first and then all the page windows are
+        fetched at once on the query pool, query_workers at a time. Results
+        come back in the same order either way.
+        """
+        if parallel is None:
+            parallel = self.parallel_queries
+
+        data_set = []
+        start_position = 1
+        if parallel:
+            total_count = self.query_count(r_type, header_auth, realm, original_payload)
+            start_positions = range(1, total_count + 1, self._max_results)
+
+            def fetch_page(position):
+                return self._query_page(r_type, header_auth, realm, qb_object, original_payload, position)
+
+            pages = self._get_query_pool().map(fetch_page, start_positions)
+            for page in pages:
+                data_set += page
+
+            if not pages or len(pages[-1]) < self._max_results:
+                return data_set
 
+            # records were added since we counted them, pick up the rest one page at a time
+            start_position = start_positions[-1] + self._max_results
 
-            # Just some math to prepare for the next iteration
-            if start_position == 0:
-                start_position = 1
+        while True:
+            page = self._query_page(r_type, header_auth, realm, qb_object, original_payload, start_position)
+            data_set += page
+            if len(page) < self._max_results:
+                break
 
-            start_position = start_position + max_results
-            payload = "{} STARTPOSITION {} MAXRESULTS {}".format(original_payload, start_position, max_results)
-            data_set += r_dict["QueryResponse"][qb_object]
+            start_position += self._max_results
 
         return data_set
 
@@ -209,7 +904,7 @@ class QuickBooks():
         if qbbo not in self._business_objects:
             raise Exception("%s is not a valid QBO Business Object." % qbbo, " (Note that this validation is case sensitive.)")
 
-        url = "https://qb.sbfinance.intuit.com/v3/company/%s/%s" % (self.company_id, qbbo.lower())
+        url = "%s/company/%s/%s" % (self.base_url_v3, self.company_id, qbbo.lower())
 
         if self.verbosity > 0:
             print "About to create a(n) %s object with this request_body:" % qbbo
@@ -221,40 +916,56 @@ class QuickBooks():
         else:
             return None
 
-        new_Id = new_object["Id"]
         attr_name = qbbo+"s"
         if not hasattr(self,attr_name):
             if self.verbosity > 0:
                 print "Creating a %ss attribute for this session." % qbbo
 
-            self.get_objects(qbbo).update({new_Id:new_object})
-        else:
-            if self.verbosity > 8:
-                print "Adding this new %s to the existing set of them." % qbbo
-                print json.dumps(new_object, indent=4)
-
-            getattr(self, attr_name)[new_Id] = new_object
+            self.get_objects(qbbo)
+        elif self.verbosity > 8:
+            print "Adding this new %s to the existing set of them." % qbbo
+            print _codec.dumps(new_object, pretty=True)
 
+        self._cache_object(qbbo, new_object)
         return new_object
 
     def read_object(self, qbbo, object_id, content_type = "json"):
         """Makes things easier for an update because you just do a read,
         tweak the things you want to change, and send that as the update
-        request body (instead of having to create one from scratch)."""
+        request body (instead of having to create one from scratch).
+        Served from the read cache (see ReadCache) or the on-disk cache,
+        if there are any, when there's a fresh copy there."""
+
+        if self.read_cache is not None:
+            key = (str(self.company_id), qbbo, str(object_id))
+            return self.read_cache.fetch(key, lambda: self._read_object(qbbo, object_id, content_type))
+
+        return self._read_object(qbbo, object_id, content_type)
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/%s/%s" % (self.company_id, qbbo.lower(), object_id)
+    def _read_object(self, qbbo, object_id, content_type="json"):
+        if self.cache is not None:
+            cached = self.cache.get(self.company_id, qbbo, object_id)
+            if cached is not None:
+                return cached
+
+        url = "%s/company/%s/%s/%s" % (self.base_url_v3, self.company_id, qbbo.lower(), object_id)
         response = self.hammer_it("GET", url, None, content_type)
         if not qbbo in response:
             return response
 
         #otherwise we don"t need the time (and outer shell)
+        self._cache_object(qbbo, response[qbbo])
         return response[qbbo]
 
-    def update_object(self, qbbo, Id, update_dict, content_type="json"):
+    def update_object(self, qbbo, Id, update_dict, content_type="json", sparse=None):
         """
         Generally before calling this, you want to call the read_object
         command on what you want to update. The alternative is forming a valid
         update request_body from scratch, which doesn"t look like fun to me.
+
+        With sparse=True (defaults to the sparse_updates constructor arg)
+        only the fields that differ from the cached version get sent, see
+        _sparse_update.
         """
 
         #todo - refactor
@@ -262,22 +973,33 @@ class QuickBooks():
             raise Exception("%s is not a valid QBO Business Object." % qbbo, " (Note that this validation is case sensitive.)")
 
         """
-        url = "https://qb.sbfinance.intuit.com/v3/company/%s/%s" % (self.company_id, qbbo.lower()) + "?operation=update"
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/%s" % (self.company_id, qbbo.lower()) + "?requestid=%s" % Id
+        url = "%s/company/%s/%s" % (self.base_url_v3, self.company_id, qbbo.lower()) + "?operation=update"
+        url = "%s/company/%s/%s" % (self.base_url_v3, self.company_id, qbbo.lower()) + "?requestid=%s" % Id
         """
 
         #see this link for url troubleshooting info:
         #http://stackoverflow.com/questions/23333300/whats-the-correct-uri-
         # for-qbo-v3-api-update-operation/23340464#23340464
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/%s" % (self.company_id, qbbo.lower())
+        url = "%s/company/%s/%s" % (self.base_url_v3, self.company_id, qbbo.lower())
 
         # NO! DON'T DO THAT, THEN YOU CAN'T DELETE STUFF YOU WANT TO DELETE!
         e_dict = update_dict
-        request_body = json.dumps(e_dict, indent=4)
+        if sparse or (sparse is None and self.sparse_updates):
+            sparse_dict = self._sparse_update(qbbo, update_dict)
+            if sparse_dict is not None:
+                if len(sparse_dict) == 3:
+                    if self.verbosity > 0:
+                        print "Nothing changed on %s Id %s, not updating it." % (qbbo, Id)
+
+                    return self._cached_entity(qbbo, update_dict["Id"])
+
+                e_dict = sparse_dict
+
+        request_body = _codec.dumps(e_dict)
         if self.verbosity > 0:
             print "About to update %s Id %s with this request_body:" % (qbbo, Id)
-            print request_body
+            print _codec.dumps(e_dict, pretty=True)
             if self.verbosity > 9:
                 raw_input("Waiting...")
 
@@ -285,23 +1007,81 @@ class QuickBooks():
         if qbbo in response:
             new_object = response[qbbo]
         else:
+            #whatever we had is likely stale (e.g. an old SyncToken)
+            if self.read_cache is not None:
+                self.read_cache.invalidate((str(self.company_id), qbbo, str(Id)))
+
             return None
 
-        attr_name = qbbo+"s"
-        if not hasattr(self,attr_name):
-            if self.verbosity > 0:
-                print "Creating a %ss attribute for this session." % qbbo
+        #no pulling the whole list just for this; if we have it, it's updated
+        if self.verbosity > 8 and hasattr(self, qbbo + "s"):
+            print "Updating this %s in the existing set of them." % qbbo
+            print _codec.dumps(new_object, pretty=True)
 
-            self.get_objects(attr_name).update({new_Id:new_object})
+        self._cache_object(qbbo, new_object)
+        return new_object
 
-        else:
-            if self.verbosity > 8:
-                print "Adding this new %s to the existing set of them." % qbbo
-                print json.dumps(new_object, indent=4)
+    def _cached_entity(self, qbbo, Id):
+        """
+        A fresh copy of the last version of an entity we've seen, as it
+        was then (from the JSON in the read cache or the on-disk cache), or
+        None. Never the <Qbbo>s entry: that may well be the very dict the
+        caller has been editing.
+        """
 
-            getattr(self, attr_name)[Id] = new_object
+        Id = str(Id)
+        if self.read_cache is not None:
+            entity = self.read_cache.get((str(self.company_id), qbbo, Id))
+            if entity is not None:
+                return entity
 
-        return new_object
+        if self.cache is not None:
+            return self.cache.get(self.company_id, qbbo, Id)
+
+        return None
+
+    def _changed_fields(self, qbbo, update_dict, base=None):
+        """
+        The top-level fields of a (full) update that differ from the
+        version it was made from (base, or the cached one, see
+        _cached_entity), as a dict, or None when we can't tell: nothing
+        cached, the cached one has another SyncToken, or a field was dropped.
+        """
+
+        if base is None:
+            base = self._cached_entity(qbbo, update_dict["Id"])
+
+        if base is None or base is update_dict or str(base.get("SyncToken")) != str(update_dict.get("SyncToken")):
+            return None
+
+        for key in base:
+            if key not in update_dict and key not in self._read_only_fields:
+                return None
+
+        changes = {}
+        for key, value in update_dict.iteritems():
+            if key in ("Id", "SyncToken") or key in self._read_only_fields:
+                continue
+
+            if key not in base or base[key] != value:
+                changes[key] = value
+
+        return changes
+
+    def _sparse_update(self, qbbo, update_dict):
+        """
+        The sparse version of a (full) update: Id, SyncToken, sparse: true
+        and just the fields that differ from the cached version (see
+        _changed_fields), or None when it has to be a full update: we can't
+        tell what changed, or a list (Line and the like, which have to go
+        whole) did.
+        """
+
+        changes = self._changed_fields(qbbo, update_dict)
+        if changes is None or any(isinstance(value, list) for value in changes.itervalues()):
+            return None
+
+        return dict(changes, Id=update_dict["Id"], SyncToken=update_dict["SyncToken"], sparse=True)
 
     def delete_object(self, qbbo, object_id=None, content_type="json", json_dict=None):
         """
@@ -316,240 +1096,401 @@ class QuickBooks():
                 raise Exception("Need either an Id or an existing object dict!")
 
         if not "Id" in json_dict: #todo - rename "Id"
-            print json.dumps(json_dict, indent=4)
+            print _codec.dumps(json_dict, pretty=True)
             raise Exception("No Id attribute found in the above dict!")
 
-        request_body = json.dumps(json_dict, indent=4)
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/%s" % (self.company_id, qbbo.lower())
+        request_body = _codec.dumps(json_dict)
+        url = "%s/company/%s/%s" % (self.base_url_v3, self.company_id, qbbo.lower())
         response = self.hammer_it("POST", url, request_body, content_type, **{"params":{"operation":"delete"}})
         if not qbbo in response:
             return response
 
+        self._uncache_object(qbbo, json_dict["Id"])
         return response[qbbo]
 
-    def upload_file(self, path, qbbo=None, Id=None): #todo - refactor
+    def batch(self, parallel=False):
         """
-        Uploads a file that can be linked to a specific transaction (or other entity probably), or not.
-        Either way, it should return the id the attachment.
+        Returns a BatchWriter for this session, see BatchWriter.
         """
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/upload" % self.company_id
-        bare_name, extension = path.rsplit("/",1)[-1].rsplit(".",1)
-        result = self.hammer_it("POST", url, None, "multipart/formdata", file_name=path)
-        attachment_id = result["AttachableResponse"][0]["Attachable"]["Id"]
-        return attachment_id
+        return BatchWriter(self, parallel)
 
-    #todo - refactor
-    def download_file(self, attachment_id, destination_dir="", alternate_name=None):
+    def write_behind(self, max_ops=30, max_delay=1.0, parallel=False, on_failure=None, max_tracked=1000):
         """
-        Download a file to the requested (or default) directory, then also
-        return a download link for convenience.
+        Returns a WriteBehind queue for this session, see WriteBehind.
         """
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/download/%s" % (self.company_id, attachment_id)
-        link =  self.hammer_it("GET", url, None, "json", accept="filelink")
-        success = False
-        tries_remaining = 6
-        while not success and tries_remaining >= 0:
-            if self.verbosity > 0 and tries_remaining < 6:
-                print "This is attempt #%d to download Attachable id %s." % (6-tries_remaining+1, attachment_id)
-
-            try:
-                my_r = requests.get(link)
-                if alternate_name:
-                    filename = alternate_name
-                else:
-                    filename = urllib.unquote(my_r.url)
-                    filename = filename.split("/./")[1].split("?")[0]
 
-                with open(destination_dir + filename, "wb") as f:
-                    for chunk in my_r.iter_content(1024):
-                        f.write(chunk)
-
-                success = True
-            except:
-                tries_remaining -= 1
-                time.sleep(1)
-                if tries_remaining == 0:
-                    print "Max retries reached..."
-                    raise #todo
-                                   
-        return link
+        return WriteBehind(self, max_ops, max_delay, parallel, on_failure, max_tracked)
 
-    def hammer_it(self, request_type, url, request_body, content_type, accept="xml", file_name=None, **req_kwargs):
+    def _cache_object(self, qbbo, new_object):
         """
-        A slim version of simonv3"s excellent keep_trying method. Among other
-         trimmings, it assumes we can only use v3 of the
-         QBO API. It also allows for requests and responses
-         in xml OR json. (No xml parsing added yet but the way is paved...)
+        Puts (a copy of) a created/updated object into the <Qbbo>s dict, if
+        we have one, and into the on-disk cache, if there is one. The caller
+        keeps the original, so tweaking it for an update doesn't touch the
+        cached list.
         """
-        self._create_session_by_demand()
-        trying = True #todo 
-        print_error = False
-        tries = 0 
-        while trying:
-            tries += 1
-            if tries > 1:
-                #we don"t want to get shut out...
-                time.sleep(1)
-
-            if self.verbosity > 0 and tries > 1:
-                print "(this is try#%d)" % tries
 
-            if accept == "filelink":
-                headers = {}
-            else:
-                headers = {"Accept": "application/%s" % accept}
+        attr_name = qbbo + "s"
+        if hasattr(self, attr_name):
+            objects = getattr(self, attr_name)
+            if not isinstance(new_object, CompactEntity):
+                new_object = _codec.loads(_codec.dumps(new_object))
+                if self.compact:
+                    new_object = CompactEntity(qbbo, new_object)
 
-            if file_name == None:
-                if not request_type == "GET":
-                    headers.update({"Content-Type":  "application/%s" % content_type})
-            else:
-                boundary = "-------------PythonMultipartPost"
-                headers.update({"Content-Type": "multipart/form-data; boundary={}".format(boundary),
-                    "Accept-Encoding": "gzip;q=1.0,deflate;q=0.6,identity;q=0.3", "User-Agent": "OAuth gem v0.4.7",
-                    "Accept":"application/json", "Connection": "close"
-                })
+            Id = new_object["Id"]
+            for index in self._indexes.get(qbbo, {}).values():
+                index.remove(Id)
+                index.add(Id, new_object)
 
-                with open(file_name, "rb") as file_handler:
-                    binary_data = file_handler.read()
+            if Id not in objects:
+                self._count_cached(1)
 
-                request_body = textwrap.dedent(
-                    """
-                    --{}
-                    Content-Disposition: form-data; name="file_content_0"; filename="{}"
-                    Content-Length: {}
-                    Content-Type: image/jpeg
-                    Content-Transfer-Encoding: binary
+            objects[Id] = new_object
 
-                    {}
+        if self.read_cache is not None:
+            self.read_cache.put((str(self.company_id), qbbo, str(new_object["Id"])), new_object)
 
-                    --{}--
-                    """
-                ).format(boundary, file_name, len(binary_data), binary_data, boundary)
+        if self.cache is not None:
+            self.cache.put(self.company_id, qbbo, new_object)
 
+    def _uncache_object(self, qbbo, Id):
+        """
+        Drops a deleted object from the <Qbbo>s dict, if we have one,
+        and from the on-disk cache, if there is one.
+        """
 
-            self._reconnect_by_demand()
-            resp = self.session.request(request_type, url, True, self.company_id, headers=headers, data=request_body, verify=False, **req_kwargs)
-            resp_cont_type = resp.headers["content-type"]
-            if "xml" in resp_cont_type:
-                result = ET.fromstring(resp.content)
-                rough_string = ET.tostring(result, "utf-8")
-                reparsed = minidom.parseString(rough_string)
-                if self.verbosity > 0:
-                    print resp
-                    if resp.status_code == 503:
-                        print " (Service Unavailable)"
-                    elif resp.status_code == 401:
-                        print " (Unauthorized -- a dubious response)"
-                    else:
-                        print " (json parse failed)"
-
-                if self.verbosity > 8:
-                    print resp.text
-                    result = None
-
-            elif "json" in resp_cont_type:
-                try:
-                    result = my_r.json()
-                except:
-                    result = {"Fault" : {"type":"(inconclusive)"}}
+        attr_name = qbbo + "s"
+        if hasattr(self, attr_name):
+            old_object = getattr(self, attr_name).pop(Id, None)
+            if old_object is not None:
+                self._count_cached(-1)
+                for index in self._indexes.get(qbbo, {}).values():
+                    index.remove(Id)
 
-                if "Fault" in result and "type" in result["Fault"] and result["Fault"]["type"] == "ValidationFault":
-                    trying = False
-                    print_error = True
+        if self.read_cache is not None:
+            self.read_cache.invalidate((str(self.company_id), qbbo, str(Id)))
 
-                elif tries >= 10:
-                    trying = False
-                    if "Fault" in result:
-                        print_error = True
+        if self.cache is not None:
+            self.cache.delete(self.company_id, qbbo, Id)
 
-                elif "Fault" not in result:
-                    #sounds like a success
-                    trying = False
+    def _set_objects(self, qbbo, object_dict):
+        """
+        Makes object_dict the <Qbbo>s dict, (re)building its indexes.
+        """
 
-                if (not trying and print_error):
-                    print json.dumps(result, indent=1)
+        #a fresh pull brings whatever's in the read cache up to date too
+        if self.read_cache is not None:
+            for key in self.read_cache.keys(str(self.company_id), qbbo):
+                if key[2] in object_dict:
+                    self.read_cache.refresh(key, object_dict[key[2]])
+
+        if self.compact:
+            for Id, entity in object_dict.iteritems():
+                if not isinstance(entity, CompactEntity):
+                    object_dict[Id] = CompactEntity(qbbo, entity)
+
+        self._count_cached(len(object_dict) - len(getattr(self, qbbo + "s", {})))
+        setattr(self, qbbo + "s", object_dict)
+        for index in self._indexes.get(qbbo, {}).values():
+            index.rebuild(object_dict)
+
+    def _count_cached(self, delta):
+        if delta:
+            self._cached_count += delta
+            if self.on_cache_change is not None:
+                self.on_cache_change(delta)
+
+    def add_index(self, qbbo, field, sorted=False):
+        """
+        Indexes the cached <Qbbo>s dict on field (a dotted path, see
+        _field_values), so lookup/lookup_range don't have to scan it. A
+        sorted index also answers range queries. Indexes are kept up to date
+        as objects are created, updated, deleted and synced.
+        """
 
-            elif "plain/text" in resp_cont_type or accept == "filelink":
-                if not "Fault" in resp.text or tries >= 10:
-                    trying = False
+        if qbbo not in self._business_objects:
+            raise Exception("{} is not a valid QBO Business Object.".format(qbbo))
 
-                else:
-                    print "Failed to get file link."
-                    if self.verbosity > 4:
-                        print resp.text
+        index = SortedIndex(field) if sorted else HashIndex(field)
+        if hasattr(self, qbbo + "s"):
+            index.rebuild(getattr(self, qbbo + "s"))
 
-                result = resp.text
+        self._indexes.setdefault(qbbo, {})[field] = index
+        return index
 
-            elif "text/html" in resp_cont_type:
-                pass #todo -???
-            else:
-                raise NotImplementedError("How do I parse a %s response?" % resp_cont_type) #todo
+    def _index(self, qbbo, field):
+        if field not in self._indexes.get(qbbo, {}):
+            raise Exception("There's no index on {} {}, see add_index.".format(qbbo, field))
 
-        return result
+        #the index is only as good as the list behind it
+        self.get_objects(qbbo)
+        return self._indexes[qbbo][field]
 
-    def keep_trying(self, r_type, url, header_auth, realm, payload=""):
-        """ 
-        Wrapper script to session.request() to continue trying at the QB
-        API until it returns something good, because the QB API is
-        inconsistent 
+    def lookup(self, qbbo, field, value):
+        """
+        The cached qbbo objects whose field equals value (for "Line." fields:
+        that have a line where it does), through the index on that field.
         """
-        
-        self._create_session_by_demand()
 
-        trying = True
-        tries = 0
-        while trying:
-            tries += 1
-            if tries > 1:
-                if self.verbosity > 0:
-                    pass
-                time.sleep(1)
+        objects = getattr(self, qbbo + "s") if hasattr(self, qbbo + "s") else {}
+        return [objects[Id] for Id in self._index(qbbo, field).lookup(value) if Id in objects]
+
+    def lookup_range(self, qbbo, field, low=None, high=None):
+        """
+        The cached qbbo objects with low <= field <= high (either end can be
+        left open), ordered by field, through a sorted index on that field.
+        """
+
+        index = self._index(qbbo, field)
+        if not isinstance(index, SortedIndex):
+            raise Exception("The index on {} {} isn't a sorted one.".format(qbbo, field))
+
+        objects = getattr(self, qbbo + "s")
+        found = []
+        seen = set()
+        for Id in index.range(low, high):
+            if Id in objects and Id not in seen:
+                seen.add(Id)
+                found.append(objects[Id])
+
+        return found
+
+    def cached_types(self):
+        """
+        The Business Object types we're holding a <Qbbo>s dict for.
+        """
+
+        return [qbbo for qbbo in self._business_objects if hasattr(self, qbbo + "s")]
+
+    def cached_object_count(self):
+        return self._cached_count
+
+    def clear_caches(self):
+        """
+        Forgets every <Qbbo>s dict (the on-disk cache, if any, is left alone).
+        """
+
+        for qbbo in self.cached_types():
+            self._count_cached(-len(getattr(self, qbbo + "s")))
+            delattr(self, qbbo + "s")
+            for index in self._indexes.get(qbbo, {}).values():
+                index.clear()
+
+        self._last_sync = {}
+
+    def upload_file(self, path, qbbo=None, Id=None, content_type=None):
+        """
+        Uploads a file that can be linked to a specific transaction (or other entity probably), or not.
+        Either way, it should return the id the attachment.
+        The file is streamed from disk, see MultipartFile.
+        """
+
+        metadata = None
+        if qbbo and Id:
+            metadata = {"AttachableRef": [{"EntityRef": {"type": qbbo, "value": str(Id)}}]}
+
+        body = MultipartFile(path, content_type, metadata)
+        url = "%s/company/%s/upload" % (self.base_url_v3, self.company_id)
+        headers = {"Content-Type": body.content_type, "Accept": "application/json"}
+        result = self._request("POST", url, "json", headers=headers, data=body)
+        attachment_id = result["AttachableResponse"][0]["Attachable"]["Id"]
+        return attachment_id
+
+    def upload_files(self, paths, qbbo=None, Id=None):
+        """
+        Uploads several files at once (on the query pool), all linked to the
+        same entity if qbbo and Id are given. Returns the attachment ids in
+        the same order as paths.
+        """
+
+        def upload(path):
+            return self.upload_file(path, qbbo, Id)
+
+        return self._get_query_pool().map(upload, paths)
+
+    def _file_link(self, attachment_id):
+        """
+        A (temporary) download link for an Attachable's file.
+        """
 
-            if self.verbosity > 0 and tries > 1:
-                print "(this is try#%d)" % tries
+        url = "%s/company/%s/download/%s" % (self.base_url_v3, self.company_id, attachment_id)
+        return self.hammer_it("GET", url, None, "json", accept="filelink")
 
-            if "v2" in url:
-                r = self.session.request(r_type, url, header_auth, realm, data=payload)
-                r_dict = xmltodict.parse(r.text)
-                if "FaultInfo" not in r_dict or tries > 10:
-                    trying = False
+    def download_file(self, attachment_id, destination_dir="", alternate_name=None):
+        """
+        Download a file to the requested (or default) directory, then also
+        return a download link for convenience.
+        """
+        link = self._file_link(attachment_id)
+        if alternate_name:
+            filename = alternate_name
+        else:
+            filename = urllib.unquote(link).split("?")[0]
+            if "/./" in filename:
+                filename = filename.split("/./")[1]
             else:
-                headers = {"Content-Type": "application/text", "Accept": "application/json"}
-                r = self.session.request(r_type, url, header_auth, realm, headers=headers, data=payload, verify=False)
-                try:
-                    r_dict = r.json()
-                except:
-                    #I've seen, e.g. a ValueError ("No JSON object could be decoded"), but there could be other errors here...
-                    if self.verbosity > 0:
-                        pass
-                    r_dict = {"Fault":{"type":"(Inconclusive)"}}
+                filename = filename.rsplit("/", 1)[-1] or str(attachment_id)
+
+        self._download_link(link, destination_dir + filename)
+        return link
 
-                if "Fault" not in r_dict or tries > 10:
-                    trying = False
-                elif "Fault" in r_dict and r_dict["Fault"]["type"] == "AUTHENTICATION":
-                    #Initially I thought to quit here, but actually
-                    #it appears that there are "false" authentication
-                    #errors all the time and you just have to keep trying...
+    def download_files(self, attachment_ids, dest="", workers=None, name_template="{Id}_{FileName}"):
+        """
+        Downloads the files of a bunch of Attachables into the dest directory,
+        several at a time (on the query pool, or on a pool of its own if you
+        give it a number of workers).
+
+        The Attachables are looked up a couple of hundred per query, which
+        gets their file names, sizes and download links without asking for
+        each link separately. A file that's already there with the right
+        size is skipped, and interrupted downloads pick up where they left
+        off (see _download_link).
+
+        Returns a dict of attachment id -> local path, or the exception for
+        the ones that failed.
+        """
 
-                    if tries > 15: #todo
-                        trying = False
-                    else:
-                        trying = True
+        ids = [str(Id) for Id in attachment_ids]
+        attachables = {}
+        for i in range(0, len(ids), 200):
+            query = "SELECT * FROM Attachable WHERE Id IN (%s)" % ", ".join(["'%s'" % Id for Id in ids[i:i + 200]])
+            for attachable in self.query_fetch_more("POST", True, self.company_id, "Attachable", query):
+                attachables[attachable["Id"]] = attachable
+
+        def download(Id):
+            attachable = attachables.get(Id, {})
+            if attachable and not attachable.get("FileName"):
+                return Id, Exception("Attachable %s has no file." % Id)
+
+            #the name comes from QB: no directories (of either kind) in it
+            file_name = re.split(r"[\\/]", attachable.get("FileName", Id))[-1]
+            if file_name in ("", ".", ".."):
+                return Id, Exception("Attachable %s has no usable file name (%r)." % (Id, attachable.get("FileName")))
+
+            path = os.path.join(dest, name_template.format(Id=Id, FileName=file_name))
+            size = attachable.get("Size")
+            if size is not None:
+                size = int(size)
+                if os.path.exists(path) and os.path.getsize(path) == size:
+                    if self.verbosity > 4:
+                        print "Already have %s." % path
 
-        if "Fault" in r_dict:
-            print r_dict
+                    return Id, path
 
-        return r_dict
+            try:
+                link = attachable.get("TempDownloadUri") or self._file_link(Id)
+                return Id, self._download_link(link, path, size)
+            except Exception as e:
+                print "Unable to download Attachable %s: %s" % (Id, e)
+                return Id, e
+
+        if workers:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(download, ids)
+            finally:
+                pool.close()
+        else:
+            results = self._get_query_pool().map(download, ids)
+
+        return dict(results)
+
+    def _download_link(self, link, path, size=None, tries=6):
+        """
+        Downloads link to path in large chunks. The data goes to path + ".part"
+        first, and a retry (or a later run) asks only for what's missing from
+        that with an HTTP Range request. Once the whole file (size bytes, if
+        we know the size) is there it's renamed to path.
+        """
+
+        part_path = path + ".part"
+        for attempt in range(1, tries + 1):
+            if attempt > 1:
+                if self.verbosity > 0:
+                    print "This is attempt #%d to download %s." % (attempt, path)
+
+                self._backoff(attempt)
+
+            have = 0
+            if os.path.exists(part_path):
+                have = os.path.getsize(part_path)
+
+            headers = {}
+            if have:
+                headers["Range"] = "bytes=%d-" % have
+
+            try:
+                resp = self._send("GET", link, oauth=False, stream=True, headers=headers)
+                if resp.status_code == 416 and have and have == size:
+                    break
+
+                resp.raise_for_status()
+
+                #a server that ignores the Range sends the whole thing again
+                mode = "ab" if have and resp.status_code == 206 else "wb"
+                with open(part_path, mode) as f:
+                    for chunk in resp.iter_content(self._download_chunk_size):
+                        f.write(chunk)
+
+                if size is not None and os.path.getsize(part_path) != size:
+                    raise IOError("Got %d of %d bytes." % (os.path.getsize(part_path), size))
+
+                break
+            except (requests.RequestException, IOError) as e:
+                if attempt == tries:
+                    print "Max retries reached..."
+                    raise
+
+                if self.verbosity > 0:
+                    print "Download of %s interrupted: %s" % (path, e)
+
+        os.rename(part_path, path)
+        return path
+
+    def hammer_it(self, request_type, url, request_body, content_type, accept=None, file_name=None, **req_kwargs):
+        """
+        A slim version of simonv3"s excellent keep_trying method. Among other
+         trimmings, it assumes we can only use v3 of the
+         QBO API. It also allows for requests and responses
+         in xml OR json (accept defaults to the request"s content_type).
+        The sending and retrying is all done by _request.
+        """
+        if accept is None:
+            accept = content_type if content_type in ["json", "xml"] else "json"
+
+        if accept == "filelink":
+            headers = {}
+        else:
+            headers = {"Accept": "application/%s" % accept}
+
+        if file_name == None:
+            if not request_type == "GET":
+                headers.update({"Content-Type":  "application/%s" % content_type})
+        else:
+            request_body = MultipartFile(file_name)
+            headers.update({"Content-Type": request_body.content_type, "Accept":"application/json"})
+
+        return self._request(request_type, url, accept, headers=headers, data=request_body, **req_kwargs)
+
+    def keep_trying(self, r_type, url, header_auth, realm, payload=""):
+        """ 
+        Wrapper script to session.request() to continue trying at the QB
+        API until it returns something good, because the QB API is
+        inconsistent (see _request for what "good" means)
+        """
+
+        if "v2" in url:
+            return self._request(r_type, url, "xml", header_auth, realm, data=payload, stream=True)
+
+        headers = {"Content-Type": "application/text", "Accept": "application/json"}
+        return self._request(r_type, url, "json", header_auth, realm, headers=headers, data=payload)
 
     def fetch_customer(self, pk):
         if pk:
-            url = self.base_url_v3 + "/company/%s/customer/%s" % (self.company_id, pk)
-            r_dict = self.keep_trying("GET", url, True, self.company_id)
-            return r_dict["Customer"]
+            return self.read_object("Customer", pk)
 
     def fetch_customers(self, all=False, page_num=0, limit=10):
-        self._create_session_by_demand()
         url = "{}/resource/customers/v2/{}".format(self.base_url_v2, self.company_id)
         customers = []
         if all:
@@ -557,37 +1498,42 @@ class QuickBooks():
             more = True
             while more:
                 payload = {"ResultsPerPage":30, "PageNum":counter}
-                trying = True
-                while trying:
-                    r = self.session.request("POST", url, header_auth=True, data=payload, realm=self.company_id)
-                    root = ET.fromstring(r.text)
-                    if root[1].tag != "{http://www.intuit.com/sb/cdm/baseexceptionmodel/xsd}ErrorCode":
-                        trying = False
-                    else:
-                        print "Failed"
-
-                self.session.close() #todo - needed?
-                qb_name = "{http://www.intuit.com/sb/cdm/v2}"
-                for child in root:
-                    if child.tag == "{http://www.intuit.com/sb/cdm/qbo}Count":
-                        if int(child.text) < 30:
-                            more = False
-                            print "Found all customers"
-
-                    if child.tag == "{http://www.intuit.com/sb/cdm/qbo}CdmCollections":
-                        for customer in child:
-                            customers += [xmltodict.parse(ET.tostring(customer))]
+                page = self._request("POST", url, "xml", data=payload, parse=self._customer_page, stream=True)
+                if page.get("Count") is None or page["Count"] < 30:
+                    more = False
+                    print "Found all customers"
 
+                customers += page.get("Customers", [])
                 counter += 1
         else:
             payload = {"ResultsPerPage":str(limit), "PageNum":str(page_num)}
-            r = self.session.request("POST", url, header_auth=True, data=payload, realm=self.company_id)
-            root = ET.fromstring(r.text)
-
-            #TODO: parse for all customers
+            page = self._request("POST", url, "xml", data=payload, parse=self._customer_page, stream=True)
+            customers += page.get("Customers", [])
 
         return customers
 
+    def _customer_page(self, resp):
+        """
+        Picks the customers (and their Count) out of a v2 customers
+        response as they're parsed, see _iter_xml.
+        """
+
+        page = {"Count": None, "Customers": []}
+        try:
+            for name, value in _iter_xml(_xml_source(resp), ("Customer", "Count", "ErrorCode"), ("Customer",)):
+                if name == "Customer":
+                    #the way xmltodict.parse(ET.tostring(customer)) had it
+                    page["Customers"].append(value)
+                elif name == "Count":
+                    page["Count"] = int(value)
+                elif name == "ErrorCode":
+                    return {"Fault": {"type": "ErrorCode"}}
+
+        except ET.ParseError:
+            return {"Fault": {"type": "(inconclusive)"}}
+
+        return page
+
     def fetch_sales_term(self, pk):
         if pk:
             url = self.base_url_v2 + "/resource/sales-term/v2/%s/%s" % ( self.company_id, pk)
@@ -608,39 +1554,18 @@ class QuickBooks():
 
     def fetch_purchases(self, **args):
         qb_object = "Purchase"
-        payload = ""
+        conditions = []
         if "query" in args and "customer" in args["query"]:
 
             # if there is a customer, let"s get the create date
             # for that customer in QB, all relevant purchases will be
             # after that date, this way we need less from QB
-
-            #todo - refactor
             customer = self.fetch_customer(args["query"]["customer"])
-            payload = "SELECT * FROM {} WHERE MetaData.CreateTime > '{}'".format(qb_object, customer["MetaData"]["CreateTime"])
-
-        else:
-            payload = "SELECT * FROM {}".format(qb_object)
-
-        unfiltered_purchases = self.query_fetch_more("POST", True, self.company_id, qb_object, payload)
-        filtered_purchases = []
-
-        #todo - refactor
-        if "query" in args and "customer" in args["query"]:
-            for entry in unfiltered_purchases:
-                if ("Line" in entry):
-                    for line in entry["Line"]:
-                        if ("AccountBasedExpenseLineDetail" in line and "CustomerRef" in \
-                                line["AccountBasedExpenseLineDetail"] and \
-                                line["AccountBasedExpenseLineDetail"]["CustomerRef"]["value"] == args["query"]["customer"]
-                            ):
-
-                            filtered_purchases += [entry]
+            conditions = [("MetaData.CreateTime", ">", customer["MetaData"]["CreateTime"]),
+                ("Line.AccountBasedExpenseLineDetail.CustomerRef", "=", args["query"]["customer"])
+            ]
 
-            return filtered_purchases
-
-        else:
-            return unfiltered_purchases
+        return list(self.filter_objects(qb_object, EntityFilter(*conditions)))
 
     def fetch_journal_entries(self, **args):
         """ Because of the beautiful way that journal entries are organized
@@ -651,100 +1576,54 @@ class QuickBooks():
         and the QB id of the customer
         """
 
-        payload = {}
-        more = True
-        journal_entries = []
-        max_results = 500
-        start_position = 0
-
-        if "query" in args and "project" in args["query"]:
-            original_payload = "SELECT * FROM JournalEntry"
-        elif "query" in args and "raw" in args["query"]:
-            original_payload = args["query"]["raw"]
-        else:
-            original_payload = "SELECT * FROM JournalEntry"
-
-        payload = original_payload + " MAXRESULTS " + str(max_results)
-        while more:
-            url = "{}/company/{}/query".format(self.base_url_v3, self.company_id)
-            r_dict = self.keep_trying("POST", url, True, self.company_id, payload)
-            if int(r_dict["QueryResponse"]["totalCount"]) < max_results:
-                more = False
-            if start_position == 0:
-                start_position = 1
-            start_position = start_position + max_results
-            payload = "%s STARTPOSITION %s MAXRESULTS %s" % (original_payload, start_position, max_results)
-            journal_entry_set = r_dict["QueryResponse"]["JournalEntry"]
-
+        conditions = []
+        if "query" in args and "class" in args["query"]:
             # This has to happen because the QBO API doesn"t support
             # filtering along customers apparently.
-            # todo - refactor
-            if "query" in args and "class" in args["query"]:
-                for entry in journal_entry_set:
-                    for line in entry["Line"]:
-                        if "JournalEntryLineDetail" in line:
-                            if "ClassRef" in line["JournalEntryLineDetail"]:
-                                if args["query"]["class"] in line["JournalEntryLineDetail"]["ClassRef"]["name"]:
-                                    journal_entries += [entry]
-                                    break
+            conditions = [("Line.JournalEntryLineDetail.ClassRef.name", "contains", args["query"]["class"])]
 
-            else:
-                journal_entries = journal_entry_set
+        query = None
+        if "query" in args and "raw" in args["query"] and not "project" in args["query"]:
+            query = args["query"]["raw"]
 
-        return journal_entries
+        return list(self.filter_objects("JournalEntry", EntityFilter(*conditions), query))
 
     def fetch_bills(self, **args):
         """
         Fetch the bills relevant to this project.
         """
-        payload = {}
-        more = True
-        counter = 1
-        bills = []
-        max_results = 500
-        start_position = 0
-        if "query" in args and "customer" in args["query"]:
-            original_payload = "SELECT * FROM Bill"
-        elif "query" in args and "raw" in args["query"]:
-            original_payload = args["query"]["raw"]
-        else:
-            original_payload = "SELECT * FROM Bill"
-
-        payload = original_payload + " MAXRESULTS " + str(max_results)
-        while more:
-            url = self.base_url_v3 + "/company/%s/query" % (self.company_id)
-            r_dict = self.keep_trying("POST", url, True, self.company_id, payload)
-            counter += 1
-            if int(r_dict["QueryResponse"]["maxResults"]) < max_results:
-                more = False
-
-            #take into account the initial start position
-            #todo
-            if start_position == 0:
-                start_position = 1
-            
-            start_position = start_position + max_results
-
-            # set new payload
-            payload = "{} STARTPOSITION {} MAXRESULTS {}".format(original_payload, start_position, max_results)
-            bill = r_dict["QueryResponse"]["Bill"]
-
+        conditions = []
+        if "query" in args and "class" in args["query"]:
             # This has to happen because the QBO API doesn"t support
             # filtering along customers apparently.
-            if "query" in args and "class" in args["query"]:
-                for entry in bill:
-                    for line in entry["Line"]:
-                        if "AccountBasedExpenseLineDetail" in line:
-                            line_detail = line["AccountBasedExpenseLineDetail"]
-                            if "ClassRef" in line_detail:
-                                name = line_detail["ClassRef"]["name"]
-                                if args["query"]["class"] in name:
-                                    bills += [entry]
-                                    break
-            else:
-                bills += bill
+            conditions = [("Line.AccountBasedExpenseLineDetail.ClassRef.name", "contains", args["query"]["class"])]
+
+        query = None
+        if "query" in args and "raw" in args["query"] and not "customer" in args["query"]:
+            query = args["query"]["raw"]
+
+        return list(self.filter_objects("Bill", EntityFilter(*conditions), query))
+
+    def filter_objects(self, qbbo, entity_filter, query=None):
+        """
+        Yields the qbbo entities that pass entity_filter (see EntityFilter).
+        Whatever part of the filter QB can do itself goes into the query's
+        WHERE clause, the rest is checked on each entity as the pages come
+        in. Pass a whole query to use that instead of the pushed-down one.
+        """
+
+        if query is None:
+            query = "SELECT * FROM %s%s" % (qbbo, entity_filter.where(qbbo))
 
-        return bills
+        if self.parallel_queries:
+            entities = self.query_fetch_more("POST", True, self.company_id, qbbo, query)
+        else:
+            entities = self.iter_query(qbbo, query)
+
+        matches = entity_filter.matches
+        for entity in entities:
+            if matches(entity):
+                yield entity
 
     def get_report(self, report_name, params = {}):
         """
@@ -752,65 +1631,156 @@ class QuickBooks():
         https://developer.intuit.com/docs/0025_quickbooksapi/0050_data_services/reports
         """
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/" % self.company_id + "reports/%s" % report_name
+        url = "%s/company/%s/reports/%s" % (self.base_url_v3, self.company_id, report_name)
         added_params_count = 0
         return self.hammer_it("GET", url, None, "json", **{"params" : params})
 
-    def query_objects(self, business_object, params={}, query_tail = ""):
+    def report_table(self, report_name, start_date, end_date, chunk="month", params={}, summaries=False):
         """
-        Runs a query-type request against the QBOv3 API
-        Gives you the option to create an AND-joined query by parameter
-            or just pass in a whole query tail
-        The parameter dicts should be keyed by parameter name and
-            have twp-item tuples for values, which are operator and criterion
+        Runs a report over a date range as a ReportTable (flat, typed
+        columns), splitting the range into chunk-sized periods ("month",
+        "quarter", "year", a number of days, or None for the whole range
+        at once) that are fetched at the same time on the query pool and
+        stitched back together in order.
+
+        Every row says which period it came from (period_start/period_end),
+        so splitting a ProfitAndLoss or a GeneralLedger loses nothing; a
+        point-in-time report like BalanceSheet should use chunk=None.
         """
 
-        if business_object not in self._business_objects:
-            raise Exception("{} not in list of QBO Business Objects. Please use one of the following: {}").format(
-                business_object, self._business_objects
-            )
+        periods = _date_chunks(start_date, end_date, chunk)
 
-        #eventually, we should be able to select more than just *,
-        #but chances are any further filtering is easier done with Python
-        #than in the query...
+        def fetch(period):
+            period_params = dict(params, start_date=period[0].isoformat(), end_date=period[1].isoformat())
+            report = self.get_report(report_name, period_params)
+            if "Fault" in report or "Columns" not in report:
+                raise Exception("{} report for {} to {} failed: {}".format(report_name, period[0], period[1], report))
 
-        query_string = "SELECT * FROM " + business_object
-        if query_tail == "" and not params == {}:
+            return ReportTable.from_report(report, period, summaries)
 
-            #It"s not entirely obvious what are valid properties for
-            #filtering, so we"ll collect the working ones here and
-            #validate the properties before sending it
-            #datatypes are defined here:
-            #https://developer.intuit.com/docs/0025_quickbooksapi/0050_data_services/020_key_concepts/0700_other_topics
+        if len(periods) > 1:
+            tables = self._get_query_pool().map(fetch, periods)
+        else:
+            tables = [fetch(period) for period in periods]
 
-            props = {"TxnDate": "Date", "MetaData.CreateTime": "DateTime", "MetaData.LastUpdatedTime": "DateTime"}
-            p = params.keys()
+        return ReportTable.concat(tables)
 
-            #only validating the property name for now, not the DataType
-            if p[0] not in props:
-                raise Exception("Unfamiliar property: {}".format(p[0]))
+    def _build_query(self, business_object, params={}, query_tail="", fields=None):
+        """
+        Builds the query string for query_objects and iter_objects (see
+        Query). Gives you the option to create an AND-joined query by
+        parameter and/or pass in a query tail, and to select just some
+        fields. The parameter dicts should be keyed by parameter name and
+        have two-item tuples for values, which are operator and criterion.
+        """
 
-            query_string += " WHERE {} {} {}".format(p[0], params[p[0]][0], params[p[0]][1])
-            if len(p) > 1:
-                for i in range(1,len(p)+1):
-                    if p[i] not in props:
-                        raise Exception("Unfamiliar property: {}".format(p[i]))
+        if business_object not in self._business_objects:
+            raise Exception("{} not in list of QBO Business Objects. Please use one of the following: {}".format(
+                business_object, self._business_objects
+            ))
 
-                    query_string += " AND {} {} {}".format(p[i], params[p[i]][0], params[p[i]][1])
+        query = Query(business_object, *(fields or []))
+        for prop, (op, criterion) in params.iteritems():
+            if isinstance(criterion, basestring) and criterion[:1] in ("'", "("):
+                #already a query literal, the way these used to be passed
+                query.where(prop, op, _Literal(criterion))
+            else:
+                query.where(prop, op, criterion)
 
-        elif not query_tail == "":
-            if not query_tail[0]==" ":
-                query_tail = " " + query_tail
-            query_string += query_tail
+        return str(query.tail(query_tail))
 
-        url = "{}/company/{}/query".format(self.base_url_v3, self.company_id)
+    def query_objects(self, business_object, params={}, query_tail = "", fields=None):
+        """
+        Runs a query-type request against the QBOv3 API
+        (see _build_query for params, query_tail and fields)
+        """
+
+        query_string = self._build_query(business_object, params, query_tail, fields)
         results = self.query_fetch_more(r_type="POST", header_auth=True, realm=self.company_id, qb_object=business_object,
             original_payload=query_string
         )
 
         return results
 
-    def get_objects(self, qbbo, requery=False, params={}, query_tail=""):
+    def iter_query(self, qbbo, query, prefetch=True):
+        """
+        Generator version of query_fetch_more: yields the records of a full
+        query string one at a time, fetching them a page at a time. While
+        you work through one page the next one is already downloading in
+        the background, so there are never more than a couple of pages in
+        memory however big the result is.
+        """
+
+        if not prefetch:
+            start_position = 1
+            while True:
+                page = self._query_page("POST", True, self.company_id, qbbo, query, start_position)
+                for record in page:
+                    yield record
+
+                if len(page) < self._max_results:
+                    return
+
+                start_position += self._max_results
+
+        pages = Queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            # don't block forever if the consumer walked away
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return True
+                except Queue.Full:
+                    pass
+
+            return False
+
+        def fetch_pages():
+            start_position = 1
+            try:
+                while True:
+                    page = self._query_page("POST", True, self.company_id, qbbo, query, start_position)
+                    #the consumer knows a short page is the last one
+                    if not put(page) or len(page) < self._max_results:
+                        return
+
+                    start_position += self._max_results
+            except Exception as e:
+                put(e)
+
+        fetcher = threading.Thread(target=fetch_pages)
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            while True:
+                page = pages.get()
+                if isinstance(page, Exception):
+                    raise page
+
+                for record in page:
+                    yield record
+
+                if len(page) < self._max_results:
+                    return
+        finally:
+            stop.set()
+
+    def iter_objects(self, qbbo, params={}, query_tail="", prefetch=True, fields=None):
+        """
+        Like query_objects, but yields the records as the pages come in
+        (see iter_query).
+        """
+
+        if qbbo in self._name_list_objects and query_tail == "":
+            #to avoid confusion from "deleted" accounts later...
+            query_tail = self._all_names_tail
+
+        query_string = self._build_query(qbbo, params, query_tail, fields)
+        return self.iter_query(qbbo, query_string, prefetch)
+
+    def get_objects(self, qbbo, requery=False, params={}, query_tail="", incremental=True, fields=None):
         """
         Rather than have to look up the account that"s associate with an
         invoice item, for example, which requires another query, it might
@@ -818,6 +1788,13 @@ class QuickBooks():
 
         The same is true with linked transactions, so transactions can
         also be cloned with this method
+
+        With requery=True an unfiltered list that was pulled (or synced)
+        in the last 30 days is just brought up to date through CDC, unless
+        incremental=False.
+
+        fields pulls just those fields of each entity (see Query), which
+        counts as filtered: it's not kept up to date through CDC or cached.
         """
 
         #we"ll call the attributes by the Business Object"s name + "s",
@@ -828,49 +1805,258 @@ class QuickBooks():
 
         elif qbbo in self._name_list_objects and query_tail == "":
             #to avoid confusion from "deleted" accounts later...
-            query_tail = "WHERE Active IN (true,false)"
+            query_tail = self._all_names_tail
 
         attr_name = qbbo + "s"
+        unfiltered = params == {} and query_tail in ["", self._all_names_tail] and not fields
+
+        #a cold start can pick the list up from the on-disk cache
+        if not hasattr(self, attr_name) and unfiltered:
+            self._load_cached_list(qbbo)
 
         #if we"ve already populated this list, only redo if told to
         #because, say, we"ve created another Account or Item or something
         #during the session
+        if requery and incremental and not fields and self._can_sync(qbbo, params, query_tail):
+            if not self.sync_objects([qbbo]):
+                return getattr(self, attr_name)
+
         if not hasattr(self,attr_name) or requery:
             if self.verbosity > 0:
                 print "Caching list of %ss." % qbbo
 
-            object_list = self.query_objects(qbbo, params, query_tail)
-
-            #let"s dictionarize it (keyed by Id), though, for easy lookup later
-            object_dict = {}
-            for o in object_list:
-                Id = o["Id"]
-                object_dict[Id] = o
+            sync_started = datetime.datetime.utcnow()
+            if self.parallel_queries:
+                object_list = self.query_objects(qbbo, params, query_tail, fields)
+            else:
+                #no need to hold the whole list and the dict at once
+                query_string = self._build_query(qbbo, params, query_tail, fields)
+                object_list = self.iter_query(qbbo, query_string)
 
-            setattr(self, attr_name, object_dict)
+            self._store_objects(qbbo, object_list, sync_started, unfiltered)
 
         return getattr(self,attr_name)
 
-    def object_dicts(self, qbbo_list=[], requery=False, params={}, query_tail=""):
+    def _load_cached_list(self, qbbo):
+        """
+        Picks up the <Qbbo>s dict from the on-disk cache, if it's there.
+        """
+
+        if self.cache is None:
+            return False
+
+        cached = self.cache.get_list(self.company_id, qbbo)
+        if cached is None:
+            return False
+
+        if self.verbosity > 0:
+            print "Loaded list of %ss from the cache." % qbbo
+
+        object_dict, self._last_sync[qbbo] = cached
+        self._set_objects(qbbo, object_dict)
+        return True
+
+    def _store_objects(self, qbbo, object_list, sync_started, unfiltered):
+        """
+        Makes a freshly pulled list the <Qbbo>s dict.
+        """
+
+        #let"s dictionarize it (keyed by Id), though, for easy lookup later
+        object_dict = {}
+        for o in object_list:
+            Id = o["Id"]
+            object_dict[Id] = o
+
+        self._set_objects(qbbo, object_dict)
+
+        #only an unfiltered list can be kept current with CDC (or cached on disk)
+        if unfiltered:
+            self._last_sync[qbbo] = sync_started
+            if self.cache is not None:
+                self.cache.put_list(self.company_id, qbbo, object_dict, sync_started)
+        else:
+            self._last_sync.pop(qbbo, None)
+
+    def _pull_objects(self, queries):
+        """
+        Runs several full queries at once, {qbbo: query} -> {qbbo: records}.
+
+        Every query is counted first, then all the page windows of all of
+        them go onto the query pool together, interleaved type by type, so
+        the pool stays busy until the biggest type is done instead of
+        draining one type at a time. Everything's submitted from here rather
+        than from inside pool jobs, so a bounded pool can't deadlock waiting
+        on itself, and the realm's RateLimiter keeps a lid on how many
+        requests are in flight across all of it.
+        """
+
+        pool = self._get_query_pool()
+        qbbos = list(queries)
+
+        def count(qbbo):
+            return self.query_count("POST", True, self.company_id, queries[qbbo])
+
+        counts = dict(zip(qbbos, pool.map(count, qbbos, 1)))
+        windows = dict((qbbo, range(1, counts[qbbo] + 1, self._max_results)) for qbbo in qbbos)
+
+        #round robin, so the big types' pages are spread through the queue
+        ordered = []
+        for i in range(max([len(w) for w in windows.values()] or [0])):
+            for qbbo in qbbos:
+                if i < len(windows[qbbo]):
+                    ordered.append((qbbo, windows[qbbo][i]))
+
+        def fetch(window):
+            qbbo, start_position = window
+            return self._query_page("POST", True, self.company_id, qbbo, queries[qbbo], start_position)
+
+        results = dict((qbbo, []) for qbbo in qbbos)
+        last = {}
+        for (qbbo, start_position), page in zip(ordered, pool.map(fetch, ordered, 1)):
+            results[qbbo] += page
+            last[qbbo] = (start_position, len(page))
+
+        #records were added since we counted them, pick up the rest one page at a time
+        for qbbo in qbbos:
+            start_position, size = last.get(qbbo, (1, 0))
+            while size == self._max_results:
+                start_position += self._max_results
+                page = self._query_page("POST", True, self.company_id, qbbo, queries[qbbo], start_position)
+                results[qbbo] += page
+                size = len(page)
+
+        return results
+
+    def _can_sync(self, qbbo, params={}, query_tail=""):
+        """
+        Whether the cached <Qbbo>s dict can be brought up to date with CDC
+        rather than pulled again from scratch.
+        """
+
+        if qbbo in self._name_list_objects and query_tail == "":
+            query_tail = self._all_names_tail
+
+        if qbbo not in self._cdc_objects or qbbo not in self._last_sync or not hasattr(self, qbbo + "s"):
+            return False
+
+        if not (params == {} and query_tail in ["", self._all_names_tail]):
+            return False
+
+        age = datetime.datetime.utcnow() - self._last_sync[qbbo]
+        return age < datetime.timedelta(days=self._cdc_window_days)
+
+    def sync_objects(self, qbbo_list):
+        """
+        Brings the cached <Qbbo>s dicts of these types up to date with a
+        single request to the Change Data Capture endpoint, merging in what
+        changed (and dropping what was deleted) since each type was last
+        pulled or synced.
+
+        Only call this for types where _can_sync is True. Returns the types
+        that could NOT be synced (e.g. QB returned a truncated change list);
+        those need a full requery.
+        """
+
+        if not qbbo_list:
+            return []
+
+        #a minute of overlap in case our clock is ahead of QB's, merging a
+        #change twice doesn't hurt
+        changed_since = min([self._last_sync[qbbo] for qbbo in qbbo_list]) - datetime.timedelta(minutes=1)
+        sync_started = datetime.datetime.utcnow()
+        if self.verbosity > 0:
+            print "Syncing %s changes since %s." % (", ".join(qbbo_list), changed_since)
+
+        url = "{}/company/{}/cdc".format(self.base_url_v3, self.company_id)
+        params = {"entities": ",".join(qbbo_list), "changedSince": changed_since.strftime("%Y-%m-%dT%H:%M:%S+00:00")}
+        response = self.hammer_it("GET", url, None, "json", accept="json", params=params)
+        if not isinstance(response, dict) or "CDCResponse" not in response:
+            return list(qbbo_list)
+
+        changes = {}
+        for cdc_response in response["CDCResponse"]:
+            for query_response in cdc_response.get("QueryResponse", []):
+                for qbbo in qbbo_list:
+                    if qbbo in query_response:
+                        changes.setdefault(qbbo, []).extend(query_response[qbbo])
+
+        not_synced = []
+        for qbbo in qbbo_list:
+            entities = changes.get(qbbo, [])
+            if len(entities) >= self._cdc_max_changes:
+                #QB cuts the list off here, so we can't trust it
+                not_synced.append(qbbo)
+                continue
+
+            for entity in entities:
+                if entity.get("status") == "Deleted":
+                    self._uncache_object(qbbo, entity["Id"])
+                else:
+                    self._cache_object(qbbo, entity)
+
+            self._last_sync[qbbo] = sync_started
+            if self.cache is not None:
+                self.cache.touch_list(self.company_id, qbbo, sync_started)
+
+        return not_synced
+
+    def object_dicts(self, qbbo_list=[], requery=False, params={}, query_tail="", incremental=True, parallel=False):
         """
         returns a dict of dicts of ALL the Business Objects of
         each of these types (filtering with params and query_tail)
+        when requerying, every type that can be is synced with one CDC request
+
+        With parallel=True the types that have to be pulled in full are
+        pulled all at once on the query pool (see _pull_objects), so it
+        takes about as long as the biggest one rather than all of them.
         """
 
-        object_dicts = {}
+        tails = {}
         for qbbo in qbbo_list:
             if qbbo == "TimeActivity":
                 #for whatever reason, this failed with some basic criteria, so
-                query_tail = ""
+                tails[qbbo] = ""
             elif qbbo in self._name_list_objects and query_tail == "":
                 #just something to avoid confusion from "deleted" accounts later
-                query_tail = "WHERE Active IN (true,false)"
+                tails[qbbo] = self._all_names_tail
+            else:
+                tails[qbbo] = query_tail
+
+        synced = []
+        if requery and incremental:
+            syncable = [qbbo for qbbo in qbbo_list if self._can_sync(qbbo, params, tails[qbbo])]
+            not_synced = self.sync_objects(syncable)
+            synced = [qbbo for qbbo in syncable if qbbo not in not_synced]
+
+        pulled = []
+        if parallel:
+            pulls = []
+            for qbbo in qbbo_list:
+                unfiltered = params == {} and tails[qbbo] in ["", self._all_names_tail]
+                if requery and qbbo not in synced:
+                    pulls.append(qbbo)
+                elif not hasattr(self, qbbo + "s") and not (unfiltered and self._load_cached_list(qbbo)):
+                    pulls.append(qbbo)
+
+            if len(pulls) > 1:
+                if self.verbosity > 0:
+                    print "Caching lists of %s." % ", ".join(pulls)
+
+                sync_started = datetime.datetime.utcnow()
+                queries = dict((qbbo, self._build_query(qbbo, params, tails[qbbo])) for qbbo in pulls)
+                for qbbo, object_list in self._pull_objects(queries).iteritems():
+                    unfiltered = params == {} and tails[qbbo] in ["", self._all_names_tail]
+                    self._store_objects(qbbo, object_list, sync_started, unfiltered)
+                    pulled.append(qbbo)
 
-            object_dicts[qbbo] = self.get_objects(qbbo, requery, params, query_tail)
+        object_dicts = {}
+        for qbbo in qbbo_list:
+            refetch = requery and qbbo not in synced and qbbo not in pulled
+            object_dicts[qbbo] = self.get_objects(qbbo, refetch, params, tails[qbbo], incremental=False)
 
         return object_dicts
 
-    def names(self, requery=False, params={}, query_tail="WHERE Active IN (true,false)"):
+    def names(self, requery=False, params={}, query_tail="WHERE Active IN (true,false)", incremental=True):
         """
         Get a dict of every Name List Business Object (of every type)
         results are subject to the filter if applicable
@@ -878,9 +2064,9 @@ class QuickBooks():
         name = names[qbbo][Id]
         """
 
-        return self.object_dicts(self._name_list_objects, requery, params, query_tail)
+        return self.object_dicts(self._name_list_objects, requery, params, query_tail, incremental)
 
-    def transactions(self, requery=False, params={}, query_tail=""):
+    def transactions(self, requery=False, params={}, query_tail="", incremental=True):
         """
         Get a dict of every Transaction Business Object (of every type)
         results are subject to the filter if applicable
@@ -888,4 +2074,2391 @@ class QuickBooks():
         transaction = transactions[qbbo][Id]
         """
 
-        return self.object_dicts(self._transaction_objects, requery, params, query_tail)
\ No newline at end of file
+        return self.object_dicts(self._transaction_objects, requery, params, query_tail, incremental)
+
+    def export_objects(self, directory, qbbo_list=None, restart=False, parallel=True):
+        """
+        Streams every entity of each type (all of _business_objects by
+        default) to <directory>/<Qbbo>.ndjson.gz, one JSON record per line,
+        writing each page as it comes in, so memory stays at about a page
+        per type however big the company is. Returns {qbbo: records}.
+
+        After every page <Qbbo>.ndjson.gz.checkpoint records the next
+        STARTPOSITION and how big the file was then; an export that gets
+        interrupted picks up from there the next time (anything written
+        after the last checkpoint is cut off first), and types that
+        finished are skipped. restart=True starts everything over.
+
+        Pages are ordered by Id so they line up between runs, but entities
+        deleted (or created with lower Ids) in between still shift the
+        offsets, so a resumed export can skip or repeat a few records
+        around that point.
+
+        Each page goes in as its own gzip member, so the file is readable
+        (gzip.open, zcat) at every checkpoint. With parallel the types are
+        exported at the same time on the query pool.
+        """
+
+        if qbbo_list is None:
+            qbbo_list = self._business_objects
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        def export(qbbo):
+            return self._export_type(qbbo, os.path.join(directory, qbbo + ".ndjson.gz"), restart)
+
+        if parallel and len(qbbo_list) > 1:
+            counts = self._get_query_pool().map(export, qbbo_list, 1)
+        else:
+            counts = [export(qbbo) for qbbo in qbbo_list]
+
+        return dict(zip(qbbo_list, counts))
+
+    def _export_type(self, qbbo, path, restart=False):
+        """
+        Exports one type for export_objects, returns how many records the
+        file holds.
+        """
+
+        checkpoint_path = path + ".checkpoint"
+        checkpoint = {"start_position": 1, "size": 0, "records": 0, "done": False}
+        if not restart and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+
+        if checkpoint["done"]:
+            if self.verbosity > 0:
+                print "%s already exported (%s records)." % (qbbo, checkpoint["records"])
+
+            return checkpoint["records"]
+
+        if qbbo == "TimeActivity":
+            #see object_dicts
+            query_tail = ""
+        elif qbbo in self._name_list_objects:
+            query_tail = self._all_names_tail
+        else:
+            query_tail = ""
+
+        #sorted, so a STARTPOSITION means the same thing from run to run
+        query = str(Query(qbbo).tail(query_tail).order_by("Id"))
+
+        with open(path, "ab") as out:
+            #drop whatever got written after the last checkpoint
+            out.truncate(checkpoint["size"])
+            out.seek(checkpoint["size"])
+
+            while True:
+                page = self._query_page("POST", True, self.company_id, qbbo, query, checkpoint["start_position"])
+                if page:
+                    member = gzip.GzipFile(filename="", mode="wb", fileobj=out)
+                    for record in page:
+                        member.write(_codec.dumps(record))
+                        member.write("\n")
+
+                    member.close()
+                    out.flush()
+                    os.fsync(out.fileno())
+
+                checkpoint["size"] = out.tell()
+                checkpoint["records"] += len(page)
+                checkpoint["start_position"] += self._max_results
+                checkpoint["done"] = len(page) < self._max_results
+                self._write_checkpoint(checkpoint_path, checkpoint)
+
+                if self.verbosity > 0:
+                    print "%s: %s records exported." % (qbbo, checkpoint["records"])
+
+                if checkpoint["done"]:
+                    return checkpoint["records"]
+
+    def _write_checkpoint(self, path, checkpoint):
+        """
+        Replaces an export checkpoint all at once, so a crash leaves either
+        the old one or the new one.
+        """
+
+        with open(path + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.name == "nt" and os.path.exists(path):
+            #no atomic replace there
+            os.remove(path)
+
+        os.rename(path + ".tmp", path)
+
+class Metrics():
+    """
+    An in-process registry of counters and histograms, fed by request
+    events (record is a hook, see QuickBooks._emit). Every QuickBooks
+    shares default_metrics unless given its own (or metrics=None).
+
+    snapshot() gives everything as plain dicts, prometheus() in the
+    Prometheus text format, for whatever exports them.
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    phases = ("queue", "wait", "transfer", "parse")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"count": 0, "sum": 0.0, "min": value, "max": value,
+                    "buckets": [0] * (len(self.buckets) + 1)}
+
+            histogram["count"] += 1
+            histogram["sum"] += value
+            histogram["min"] = min(histogram["min"], value)
+            histogram["max"] = max(histogram["max"], value)
+            histogram["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+
+    def record(self, event):
+        kind = event["event"]
+        realm = str(event["realm"])
+        entity = event.get("entity") or "(other)"
+        if kind == "request":
+            self.incr("qb_requests_total", realm=realm, entity=entity, status=str(event["status"]), fault=event["fault"] or "")
+            self.incr("qb_bytes_sent_total", event["bytes_sent"], realm=realm, entity=entity)
+            self.incr("qb_bytes_received_total", event["bytes_received"], realm=realm, entity=entity)
+            for phase in self.phases:
+                if phase in event:
+                    self.observe("qb_request_seconds", event[phase], realm=realm, entity=entity, phase=phase)
+
+            self.observe("qb_request_seconds", sum(event.get(phase, 0) for phase in self.phases), realm=realm, entity=entity, phase="total")
+
+        elif kind == "error":
+            self.incr("qb_request_errors_total", realm=realm, entity=entity)
+        elif kind == "retry":
+            self.incr("qb_retries_total", realm=realm, entity=entity)
+        elif kind == "throttled":
+            self.incr("qb_throttled_total", realm=realm)
+        elif kind == "giving_up":
+            self.incr("qb_giveups_total", realm=realm, entity=entity, fault=event["fault"] or "")
+
+    def quantile(self, q, name="qb_request_seconds", **labels):
+        """
+        Estimates a quantile (0 < q < 1) of a histogram from its buckets,
+        summing over any labels not given.
+        """
+
+        with self._lock:
+            matches = [h for (n, l), h in self.histograms.iteritems()
+                if n == name and set(labels.iteritems()) <= set(l)]
+
+        count = sum(h["count"] for h in matches)
+        if not count:
+            return None
+
+        target = q * count
+        seen = 0
+        for i in range(len(self.buckets) + 1):
+            seen += sum(h["buckets"][i] for h in matches)
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else max(h["max"] for h in matches)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [dict(labels, name=name, value=value) for (name, labels), value in self.counters.iteritems()],
+                "histograms": [dict(labels, name=name, **dict(h, buckets=list(h["buckets"])))
+                    for (name, labels), h in self.histograms.iteritems()]}
+
+    def prometheus(self):
+        def label_text(labels, **extra):
+            labels = list(labels) + sorted(extra.iteritems())
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels) if labels else ""
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.iteritems()):
+                lines.append("%s%s %s" % (name, label_text(labels), value))
+
+            for (name, labels), h in sorted(self.histograms.iteritems()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + ("+Inf",), h["buckets"]):
+                    cumulative += n
+                    lines.append("%s_bucket%s %d" % (name, label_text(labels, le=bound), cumulative))
+
+                lines.append("%s_sum%s %f" % (name, label_text(labels), h["sum"]))
+                lines.append("%s_count%s %d" % (name, label_text(labels), h["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+default_metrics = Metrics()
+
+class RateLimiter():
+    """
+    A token bucket (plus a cap on requests in flight) for one realm. QBO allows a realm roughly 500
+    requests a minute, so by default requests are let through at 8 a second
+    with bursts of up to 10.
+
+    It adapts: when QB throttles a request (HTTP 429 / ThrottleExceeded) the
+    rate is halved and everybody waits out the Retry-After, then every
+    successful request creeps the rate back up towards max_rate.
+
+    RateLimiter.for_realm hands out one shared limiter per realm, so every
+    QuickBooks instance (and thread) talking to a realm counts against the
+    same bucket. state() shows where it stands.
+    """
+
+    _realms = {}
+    _realms_lock = threading.Lock()
+
+    @classmethod
+    def for_realm(cls, realm, rate=None, burst=None, concurrency=None):
+        with cls._realms_lock:
+            if str(realm) not in cls._realms:
+                cls._realms[str(realm)] = cls(rate, burst, concurrency=concurrency)
+
+            return cls._realms[str(realm)]
+
+    def __init__(self, rate=None, burst=None, min_rate=0.5, concurrency=None):
+        self.max_rate = float(rate or 8.0)
+        self.rate = self.max_rate
+        self.min_rate = min(min_rate, self.max_rate)
+        self.burst = float(burst or 10)
+        self.tokens = self.burst
+        self.paused_until = 0.0
+
+        self.requests = 0
+        self.throttled_count = 0
+        self.waited = 0.0
+
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+        #QBO also caps concurrent requests per realm (at 10)
+        self.concurrency = concurrency or 10
+        self.in_flight = 0
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+
+    def _refill(self, now):
+        # nothing accrues while we're paused (_last_refill is in the future then)
+        if now > self._last_refill:
+            self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+
+    def acquire(self):
+        """
+        Blocks until the next request may go out. Call release() once it's
+        done.
+        """
+
+        self._slots.acquire()
+        with self._lock:
+            self.in_flight += 1
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return
+
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+                self.waited += wait
+
+            time.sleep(wait)
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+        self._slots.release()
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            self.throttled_count += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, time.time() + (retry_after or 1 / self.rate))
+            self._last_refill = max(self._last_refill, self.paused_until)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+    def state(self):
+        with self._lock:
+            self._refill(time.time())
+            return {"rate": self.rate, "max_rate": self.max_rate, "burst": self.burst, "tokens": self.tokens,
+                "paused_for": max(0.0, self.paused_until - time.time()), "requests": self.requests,
+                "throttled": self.throttled_count, "waited": self.waited, "in_flight": self.in_flight,
+                "concurrency": self.concurrency
+            }
+
+
+class ReadCache():
+    """
+    A bounded, in-memory LRU cache in front of single-entity reads
+    (QuickBooks.read_object, fetch_customer), keyed by realm, type and Id.
+
+    Entities are kept as JSON, so every hit hands out a fresh copy that's
+    safe to tweak and send back as an update. Whatever passes through the
+    client (reads, writes, batch results, CDC syncs and full pulls) keeps
+    it current, but only if its SyncToken isn't older than what's cached,
+    so a late response can't put back a stale version; deletes and failed
+    updates drop the entry. ttl (seconds, None for never) bounds how long
+    an entry is trusted for changes made by somebody else.
+
+    Identical reads that are already in flight share the one request.
+
+    It's off unless asked for: QuickBooks makes its own given
+    read_cache_size (and read_cache_ttl, a minute by default), or pass
+    read_cache=... to share one between clients.
+    """
+
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _version(entity):
+        try:
+            return int(entity.get("SyncToken"))
+        except (TypeError, ValueError, AttributeError):
+            return -1
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            body, version, stored_at = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+
+            #most recently used goes to the end
+            del self.entries[key]
+            self.entries[key] = entry
+
+        return _codec.loads(body)
+
+    def put(self, key, entity):
+        version = self._version(entity)
+        body = _codec.dumps(entity)
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[1] > version:
+                #we've already seen a newer one
+                self.entries[key] = entry
+                return
+
+            self.entries[key] = (body, version, time.time())
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def refresh(self, key, entity):
+        """
+        put, but only if the entity's cached already.
+        """
+
+        if key in self.entries:
+            self.put(key, entity)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def keys(self, realm, qbbo):
+        with self._lock:
+            return [key for key in self.entries if key[0] == realm and key[1] == qbbo]
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def fetch(self, key, read):
+        """
+        The cached entity, or read() it (which should cache it), sharing
+        the read with anyone else asking for the same key meanwhile.
+        """
+
+        entity = self.get(key)
+        if entity is not None:
+            self.hits += 1
+            return entity
+
+        with self._lock:
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = {"done": threading.Event()}
+
+        if not leader:
+            self.coalesced += 1
+            flight["done"].wait()
+            if "error" in flight:
+                raise flight["error"]
+
+            return _codec.loads(flight["body"])
+
+        self.misses += 1
+        try:
+            flight["body"] = _codec.dumps(read())
+            #a copy for us too, read() may hand back a live <Qbbo>s entry
+            return _codec.loads(flight["body"])
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self.in_flight[key]
+
+            flight["done"].set()
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+class EntityCache():
+    """
+    An on-disk (SQLite) entity cache that outlives the process, so that
+    restarted workers and cron runs don't have to pull every list again.
+    Entities are keyed by realm, type and Id and stored as JSON along with
+    their SyncToken and LastUpdatedTime.
+
+    ttl is in seconds: older entities aren't served and get evicted (None
+    means they never expire). max_entries caps the number of entities kept,
+    the least recently refreshed ones going first. A complete <Qbbo>s list
+    is only served while none of its entities have been evicted.
+
+    Pass one to QuickBooks as cache=..., or just give it cache_path (and
+    optionally cache_ttl, cache_size) and it'll make its own.
+    """
+
+    _evict_every = 1000
+
+    def __init__(self, path, ttl=None, max_entries=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS entities (
+                    realm TEXT, qbbo TEXT, id TEXT, sync_token TEXT, last_updated TEXT,
+                    body TEXT, cached_at REAL, PRIMARY KEY (realm, qbbo, id)
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entities_cached_at ON entities (cached_at)")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS lists (
+                    realm TEXT, qbbo TEXT, synced_at TEXT, cached_at REAL, PRIMARY KEY (realm, qbbo)
+                )
+            """)
+            self.conn.commit()
+
+        self.evict()
+
+    def _fresh_since(self):
+        if self.ttl is None:
+            return 0
+
+        return time.time() - self.ttl
+
+    def get(self, realm, qbbo, Id):
+        """
+        Returns the cached entity, or None.
+        """
+
+        with self._lock:
+            row = self.conn.execute("SELECT body FROM entities WHERE realm=? AND qbbo=? AND id=? AND cached_at>=?",
+                (str(realm), qbbo, str(Id), self._fresh_since())
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return _codec.loads(row[0])
+
+    def put(self, realm, qbbo, entity, commit=True):
+        row = (str(realm), qbbo, str(entity["Id"]), entity.get("SyncToken"),
+            entity.get("MetaData", {}).get("LastUpdatedTime"), _codec.dumps(entity), time.time()
+        )
+
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            if commit:
+                self.conn.commit()
+
+            self._puts += 1
+
+        if self._puts % self._evict_every == 0:
+            self.evict()
+
+    def delete(self, realm, qbbo, Id):
+        with self._lock:
+            self.conn.execute("DELETE FROM entities WHERE realm=? AND qbbo=? AND id=?", (str(realm), qbbo, str(Id)))
+            self.conn.commit()
+
+    def get_list(self, realm, qbbo):
+        """
+        Returns (object_dict, synced_at) for a complete, fresh list of this
+        type, or None.
+        """
+
+        with self._lock:
+            row = self.conn.execute("SELECT synced_at FROM lists WHERE realm=? AND qbbo=? AND cached_at>=?",
+                (str(realm), qbbo, self._fresh_since())
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            rows = self.conn.execute("SELECT id, body FROM entities WHERE realm=? AND qbbo=?", (str(realm), qbbo)).fetchall()
+
+        object_dict = {}
+        for Id, body in rows:
+            object_dict[Id] = _codec.loads(body)
+
+        return object_dict, datetime.datetime.strptime(row[0], "%Y-%m-%dT%H:%M:%S.%f")
+
+    def put_list(self, realm, qbbo, object_dict, synced_at):
+        """
+        Replaces everything cached for this type with a complete list.
+        """
+
+        realm = str(realm)
+        now = time.time()
+        rows = []
+        for Id, entity in object_dict.iteritems():
+            rows.append((realm, qbbo, str(Id), entity.get("SyncToken"), entity.get("MetaData", {}).get("LastUpdatedTime"),
+                _codec.dumps(entity), now
+            ))
+
+        with self._lock:
+            self.conn.execute("DELETE FROM entities WHERE realm=? AND qbbo=?", (realm, qbbo))
+            self.conn.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO lists VALUES (?, ?, ?, ?)",
+                (realm, qbbo, synced_at.strftime("%Y-%m-%dT%H:%M:%S.%f"), now)
+            )
+            self.conn.commit()
+
+        self.evict()
+
+    def touch_list(self, realm, qbbo, synced_at):
+        """
+        Marks a cached list (and everything in it) as current as of synced_at,
+        e.g. after merging in the changes from CDC.
+        """
+
+        realm = str(realm)
+        now = time.time()
+        with self._lock:
+            updated = self.conn.execute("UPDATE lists SET synced_at=?, cached_at=? WHERE realm=? AND qbbo=?",
+                (synced_at.strftime("%Y-%m-%dT%H:%M:%S.%f"), now, realm, qbbo)
+            ).rowcount
+
+            if updated:
+                self.conn.execute("UPDATE entities SET cached_at=? WHERE realm=? AND qbbo=?", (now, realm, qbbo))
+
+            self.conn.commit()
+
+    def evict(self):
+        """
+        Drops expired entities, then the oldest ones while there are more
+        than max_entries. Lists that lose any entity are no longer complete,
+        so they're forgotten too.
+        """
+
+        with self._lock:
+            cutoff = self._fresh_since()
+            if self.max_entries is not None:
+                row = self.conn.execute("SELECT cached_at FROM entities ORDER BY cached_at DESC LIMIT 1 OFFSET ?",
+                    (self.max_entries,)
+                ).fetchone()
+
+                if row is not None:
+                    cutoff = max(cutoff, row[0] + 1e-6)
+
+            self.conn.execute("""
+                DELETE FROM lists WHERE cached_at<? OR EXISTS (
+                    SELECT 1 FROM entities WHERE entities.realm=lists.realm AND entities.qbbo=lists.qbbo AND cached_at<?
+                )
+            """, (cutoff, cutoff))
+            self.conn.execute("DELETE FROM entities WHERE cached_at<?", (cutoff,))
+            self.conn.commit()
+
+    def clear(self, realm=None):
+        with self._lock:
+            if realm is None:
+                self.conn.execute("DELETE FROM entities")
+                self.conn.execute("DELETE FROM lists")
+            else:
+                self.conn.execute("DELETE FROM entities WHERE realm=?", (str(realm),))
+                self.conn.execute("DELETE FROM lists WHERE realm=?", (str(realm),))
+
+            self.conn.commit()
+
+
+class BatchWriter():
+    """
+    Collects create/update/delete operations and sends them through the QBO
+    batch endpoint, up to 30 operations per request:
+
+        batch = qb.batch()
+        for invoice in invoices:
+            batch.create("Invoice", invoice)
+        results = batch.send()
+
+    or, equivalently, "with qb.batch() as batch: ..." which sends on exit.
+
+    send() returns one result per operation, in the order they were added:
+    the entity dict QB sent back, or a {"Fault": ...} dict if that operation
+    failed. With parallel=True the batches are sent several at a time on the
+    session's query pool.
+    """
+
+    _batch_size = 30
+
+    def __init__(self, qb, parallel=False):
+        self.qb = qb
+        self.parallel = parallel
+        self.operations = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def add(self, operation, qbbo, json_dict):
+        """
+        Queues an operation, returns its index in the results list.
+        """
+
+        if qbbo not in self.qb._business_objects:
+            raise Exception("%s is not a valid QBO Business Object." % qbbo, " (Note that this validation is case sensitive.)")
+
+        if operation in ["update", "delete"] and not "Id" in json_dict:
+            raise Exception("No Id attribute found in the %s to %s!" % (qbbo, operation))
+
+        self.operations.append((operation, qbbo, json_dict))
+        return len(self.operations) - 1
+
+    def create(self, qbbo, json_dict):
+        return self.add("create", qbbo, json_dict)
+
+    def update(self, qbbo, json_dict):
+        return self.add("update", qbbo, json_dict)
+
+    def delete(self, qbbo, json_dict):
+        return self.add("delete", qbbo, json_dict)
+
+    def send(self):
+        """
+        Sends everything queued so far and clears the queue.
+        """
+
+        operations, self.operations = self.operations, []
+        chunks = [range(i, min(i + self._batch_size, len(operations))) for i in range(0, len(operations), self._batch_size)]
+
+        def send_chunk(indexes):
+            return self._send_chunk(operations, indexes)
+
+        if self.parallel and len(chunks) > 1:
+            chunk_results = self.qb._get_query_pool().map(send_chunk, chunks)
+        else:
+            chunk_results = [send_chunk(chunk) for chunk in chunks]
+
+        results = []
+        for chunk_result in chunk_results:
+            results += chunk_result
+
+        self.results += results
+        return results
+
+    def _send_chunk(self, operations, indexes):
+        qb = self.qb
+        items = []
+        for i in indexes:
+            operation, qbbo, json_dict = operations[i]
+            items.append({"bId": str(i), "operation": operation, qbbo: json_dict})
+
+        url = "{}/company/{}/batch".format(qb.base_url_v3, qb.company_id)
+        request_body = _codec.dumps({"BatchItemRequest": items})
+        if qb.verbosity > 0:
+            print "Sending a batch of %d operations (%d to %d)." % (len(indexes), indexes[0], indexes[-1])
+
+        response = qb.hammer_it("POST", url, request_body, "json", accept="json")
+        by_bId = {}
+        if isinstance(response, dict):
+            if "Fault" in response:
+                # the whole batch went down
+                return [{"Fault": response["Fault"]} for i in indexes]
+
+            for item in response.get("BatchItemResponse", []):
+                by_bId[item["bId"]] = item
+
+        results = []
+        for i in indexes:
+            operation, qbbo, json_dict = operations[i]
+            item = by_bId.get(str(i), {"Fault": {"type": "(no response for this operation)"}})
+            if qbbo in item:
+                result = item[qbbo]
+                if operation == "delete":
+                    qb._uncache_object(qbbo, json_dict["Id"])
+                else:
+                    qb._cache_object(qbbo, result)
+            else:
+                result = {"Fault": item.get("Fault", item)}
+                if qb.verbosity > 0:
+                    print "Batch %s of %s failed:" % (operation, qbbo), json.dumps(result, indent=1)
+
+            results.append(result)
+
+        return results
+
+
+class WriteFuture():
+    """
+    The eventual result of one queued write (see WriteBehind): the entity
+    QB sent back, or a {"Fault": ...} dict if the write failed. result()
+    waits for it (raising if the request itself blew up, or if timeout
+    seconds go by first).
+    """
+
+    def __init__(self, operation, qbbo, Id=None):
+        self.operation = operation
+        self.qbbo = qbbo
+        self.Id = Id
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise Exception("Timed out waiting for the {} of {} {}".format(self.operation, self.qbbo, self.Id or ""))
+
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+    def exception(self, timeout=None):
+        self._done.wait(timeout)
+        return self._exception
+
+    def failed(self):
+        """
+        Whether it's done and didn't work (a Fault, or an exception).
+        """
+
+        return self.done() and (self._exception is not None or (isinstance(self._result, dict) and "Fault" in self._result))
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def _finish(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print "WriteFuture callback %r failed: %s" % (callback, e)
+
+class WriteBehind():
+    """
+    Queues creates, updates and deletes and sends them from a background
+    thread in batches (see BatchWriter), so whoever's making the changes
+    never waits on QB:
+
+        writes = qb.write_behind()
+        future = writes.update("Invoice", invoice)
+        ...
+        writes.close()          # or "with qb.write_behind() as writes:"
+
+    Every write returns a WriteFuture. A batch goes out once max_ops writes
+    are waiting or the oldest has waited max_delay seconds (or on flush()).
+
+    An update to an Id that's still waiting, made from the same version
+    (SyncToken), is merged into the waiting one: just the fields it
+    changed from that version (see QuickBooks._changed_fields) go on top,
+    so neither edit is lost. A delete of the same version swallows a
+    waiting update. So a burst of small edits to the same Invoice is one
+    request, and all the merged writes' futures get its result. When we
+    can't tell what an update changed it's queued on its own instead.
+
+    A write made from a version this queue has since updated itself gets
+    the new SyncToken, but only if it's a delete or an update we know the
+    changes of, which then goes out as a sparse update of just those.
+    Anything else keeps its SyncToken and QB turns it down as stale, the
+    same as it would without the queue. What that takes (the version each
+    entity's edits were made from, and the SyncTokens the queue moved it
+    through) is only kept for the max_tracked most recently written
+    entities; writes to one that's dropped out just keep their SyncToken.
+
+    Failures (Faults, or requests that blew up) are in failures as
+    (future, result or exception), and go to on_failure(future, result) if
+    given. Note that the queue isn't bounded.
+    """
+
+    #SyncTokens remembered per entity, see _send
+    _max_versions = 20
+
+    def __init__(self, qb, max_ops=30, max_delay=1.0, parallel=False, on_failure=None, max_tracked=1000):
+        self.qb = qb
+        self.max_ops = max_ops
+        self.max_tracked = max_tracked
+        self.max_delay = max_delay
+        self.parallel = parallel
+        self.on_failure = on_failure
+        self.failures = []
+        self.sent = 0
+        self.coalesced = 0
+
+        self._pending = []
+        self._in_flight = []
+        self._waiting = {}
+        self._versions = collections.OrderedDict()
+        self._bases = collections.OrderedDict()
+        self._flushing = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def create(self, qbbo, json_dict):
+        return self._add("create", qbbo, json_dict)
+
+    def update(self, qbbo, json_dict):
+        return self._add("update", qbbo, json_dict)
+
+    def delete(self, qbbo, json_dict):
+        return self._add("delete", qbbo, json_dict)
+
+    def _add(self, operation, qbbo, json_dict):
+        if qbbo not in self.qb._business_objects:
+            raise Exception("%s is not a valid QBO Business Object." % qbbo, " (Note that this validation is case sensitive.)")
+
+        if operation in ["update", "delete"] and not "Id" in json_dict:
+            raise Exception("No Id attribute found in the %s to %s!" % (qbbo, operation))
+
+        Id = json_dict.get("Id")
+        key = (qbbo, str(Id))
+        changes = None
+        if operation == "update":
+            #what it changes from the version it was made from; our own writes
+            #replace that in the caches, so we hang on to it for the next edit
+            with self._cond:
+                base = self._bases.get(key)
+
+            if base is None or str(base.get("SyncToken")) != str(json_dict.get("SyncToken")):
+                base = self.qb._cached_entity(qbbo, Id)
+
+            changes = self.qb._changed_fields(qbbo, json_dict, base)
+            if changes is not None:
+                with self._cond:
+                    self._track(self._bases, key, base)
+
+        future = WriteFuture(operation, qbbo, Id)
+        with self._cond:
+            if self._closed:
+                raise Exception("This WriteBehind has been closed.")
+
+            waiting = self._waiting.get(key) if Id is not None else None
+            if (waiting is not None and waiting["operation"] == "update"
+                and str(waiting["entity"].get("SyncToken")) == str(json_dict.get("SyncToken"))
+                and (operation == "delete" or changes is not None)):
+                if operation == "update":
+                    #just what this one changed, so the waiting edits survive
+                    waiting["entity"].update(changes)
+                    if waiting["changes"] is not None:
+                        waiting["changes"].update(changes)
+                else:
+                    waiting["entity"] = dict(json_dict)
+                    waiting["changes"] = None
+
+                waiting["operation"] = operation
+                waiting["futures"].append(future)
+                self.coalesced += 1
+            else:
+                write = {"operation": operation, "qbbo": qbbo, "entity": dict(json_dict), "changes": changes,
+                    "futures": [future], "queued_at": time.time()}
+                self._pending.append(write)
+                if Id is not None:
+                    self._waiting[key] = write
+
+            self._cond.notify()
+
+        return future
+
+    def _track(self, table, key, value):
+        """
+        Puts value in one of the per-entity tables as the most recently
+        used, dropping the least recently used past max_tracked.
+        """
+
+        table.pop(key, None)
+        table[key] = value
+        while len(table) > self.max_tracked:
+            table.popitem(last=False)
+
+    def _due(self):
+        if not self._pending:
+            return False
+
+        return (self._flushing or self._closed or len(self._pending) >= self.max_ops
+            or time.time() - self._pending[0]["queued_at"] >= self.max_delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    if self._closed:
+                        return
+
+                    timeout = None
+                    if self._pending:
+                        timeout = max(0.0, self._pending[0]["queued_at"] + self.max_delay - time.time())
+
+                    self._cond.wait(timeout)
+
+                writes, self._pending = self._pending, []
+                self._in_flight = writes
+                self._waiting = {}
+                self._flushing = False
+
+            try:
+                self._send(writes)
+            finally:
+                with self._cond:
+                    self._in_flight = []
+
+    def _send(self, writes):
+        batch = BatchWriter(self.qb, self.parallel)
+        for write in writes:
+            entity = write["entity"]
+            newer = None
+            if write["operation"] != "create":
+                #has this queue updated the version it was made from?
+                newer = self._versions.get((write["qbbo"], str(entity["Id"])), {}).get(str(entity.get("SyncToken")))
+
+            changes = write["changes"]
+            if newer is not None and write["operation"] == "delete":
+                entity = dict(entity, SyncToken=newer)
+            elif newer is not None and changes is not None and not any(isinstance(v, list) for v in changes.itervalues()):
+                entity = dict(changes, Id=entity["Id"], SyncToken=newer, sparse=True)
+            elif write["operation"] == "update" and self.qb.sparse_updates:
+                entity = self.qb._sparse_update(write["qbbo"], entity) or entity
+
+            write["sent_token"] = str(entity.get("SyncToken"))
+            batch.add(write["operation"], write["qbbo"], entity)
+
+        try:
+            results = batch.send()
+        except Exception as e:
+            results = [e] * len(writes)
+
+        self.sent += len(writes)
+        for write, result in zip(writes, results):
+            failed = isinstance(result, Exception) or (isinstance(result, dict) and "Fault" in result)
+            if not failed and write["operation"] == "update" and "SyncToken" in result:
+                #whatever led up to the version we just replaced leads here now
+                key = (write["qbbo"], str(result["Id"]))
+                versions = self._versions.get(key) or collections.OrderedDict()
+                for token, newest in versions.items():
+                    if newest == write["sent_token"]:
+                        versions[token] = str(result["SyncToken"])
+
+                versions.pop(write["sent_token"], None)
+                versions[write["sent_token"]] = str(result["SyncToken"])
+                while len(versions) > self._max_versions:
+                    versions.popitem(last=False)
+
+                self._track(self._versions, key, versions)
+            elif not failed and write["operation"] == "delete":
+                key = (write["qbbo"], str(write["entity"]["Id"]))
+                self._versions.pop(key, None)
+                with self._cond:
+                    self._bases.pop(key, None)
+
+            for future in write["futures"]:
+                if isinstance(result, Exception):
+                    future._finish(exception=result)
+                else:
+                    future._finish(result)
+
+                if failed:
+                    self.failures.append((future, result))
+                    if self.on_failure is not None:
+                        try:
+                            self.on_failure(future, result)
+                        except Exception as e:
+                            print "WriteBehind on_failure callback failed: %s" % e
+
+    def pending(self):
+        with self._cond:
+            return sum(len(write["futures"]) for write in self._pending)
+
+    def flush(self, timeout=None):
+        """
+        Sends whatever's waiting now, and waits for it (and anything
+        already on its way) to be done.
+        """
+
+        with self._cond:
+            futures = [future for write in self._in_flight + self._pending for future in write["futures"]]
+            self._flushing = True
+            self._cond.notify()
+
+        for future in futures:
+            future.exception(timeout)
+
+    def close(self, timeout=None):
+        """
+        Sends what's left and stops the background thread.
+        """
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+        self._thread.join(timeout)
+
+
+class MultipartFile():
+    """
+    A multipart/form-data request body for the upload endpoint that streams
+    the file from disk as it's sent, instead of reading it into memory.
+    Its len() is known up front so Content-Length is set properly, and the
+    part's Content-Type is guessed from the file name unless given.
+    metadata, if any, goes along as the file's Attachable JSON (that's how
+    an upload gets linked to an entity).
+    """
+
+    boundary = "-------------PythonMultipartPost"
+    chunk_size = 64 * 1024
+
+    def __init__(self, path, content_type=None, metadata=None):
+        self.path = path
+        self.file_name = os.path.basename(path)
+        self.mime_type = content_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+
+        head = ""
+        if metadata is not None:
+            metadata = dict(metadata, FileName=self.file_name, ContentType=self.mime_type)
+            head += "--%s\r\nContent-Disposition: form-data; name=\"file_metadata_0\"\r\n" % self.boundary
+            head += "Content-Type: application/json; charset=UTF-8\r\n\r\n%s\r\n" % _codec.dumps(metadata)
+
+        head += "--%s\r\nContent-Disposition: form-data; name=\"file_content_0\"; filename=\"%s\"\r\n" % (self.boundary, self.file_name)
+        head += "Content-Type: %s\r\n\r\n" % self.mime_type
+
+        #a unicode path makes it unicode; it has to go out (and be counted) as bytes
+        if isinstance(head, unicode):
+            head = head.encode("utf-8")
+
+        self._head = head
+        self._tail = "\r\n--%s--\r\n" % self.boundary
+        self._file_size = os.path.getsize(path)
+        self._parts = []
+        self.rewind()
+
+    def __len__(self):
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def __contains__(self, key):
+        #rauth looks for oauth_* parameters in the request data
+        return False
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+
+            yield chunk
+
+    def rewind(self):
+        self.close()
+        self._parts = [cStringIO.StringIO(self._head), None, cStringIO.StringIO(self._tail)]
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            if self._parts[0] is None:
+                #the file is only opened once we get to it
+                self._parts[0] = open(self.path, "rb")
+
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+
+        return "".join(chunks)
+
+    def close(self):
+        for part in self._parts:
+            if part is not None:
+                part.close()
+
+        self._parts = []
+
+
+class EntityFilter():
+    """
+    A filter over entities and their lines, compiled once up front and then
+    run in a single pass over each entity. Conditions are (field, operator,
+    value) tuples that all have to hold:
+
+        EntityFilter(("TxnDate", ">=", datetime.date(2015, 1, 1)),
+            ("Line.ClassRef.name", "contains", "Project X"),
+            ("Line.Amount", ">", 100)
+        )
+
+    Fields are dotted paths into the entity. "Line." ones are checked on
+    each line (and an entity passes if ANY of its lines passes all of them);
+    a line field that isn't on the line itself is looked up in the line's
+    detail (e.g. AccountBasedExpenseLineDetail), so "Line.ClassRef" works
+    for any line type. Refs compare by their value (Id) unless you ask for
+    ".name". Entities missing a field don't pass that condition.
+
+    where(qbbo) turns the header conditions QB can handle into a WHERE
+    clause, see QuickBooks.filter_objects.
+    """
+
+    _ops = {
+        "=": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "in": lambda a, b: a in b,
+        "contains": lambda a, b: isinstance(a, basestring) and b in a,
+    }
+
+    _query_ops = {"=": "=", "<": "<", "<=": "<=", ">": ">", ">=": ">=", "in": "IN"}
+
+    def __init__(self, *conditions):
+        self.conditions = []
+        header_tests = []
+        line_tests = []
+        for field, op, value in conditions:
+            if op not in self._ops:
+                raise Exception("Unknown operator: {}".format(op))
+
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                value = value.isoformat()
+
+            self.conditions.append((field, op, value))
+            if field.startswith("Line."):
+                line_tests.append(self._compile(field[5:].split("."), self._ops[op], value, True))
+            else:
+                header_tests.append(self._compile(field.split("."), self._ops[op], value))
+
+        def matches(entity):
+            for test in header_tests:
+                if not test(entity):
+                    return False
+
+            if not line_tests:
+                return True
+
+            for line in entity.get("Line", []):
+                for test in line_tests:
+                    if not test(line):
+                        break
+                else:
+                    return True
+
+            return False
+
+        self.matches = matches
+
+    def _compile(self, path, compare, value, on_line=False):
+        def test(obj):
+            if on_line and path[0] not in obj and obj.get("DetailType") in obj:
+                obj = obj[obj["DetailType"]]
+
+            for key in path:
+                if not isinstance(obj, _mapping_types) or key not in obj:
+                    return False
+
+                obj = obj[key]
+
+            if isinstance(obj, _mapping_types) and "value" in obj:
+                obj = obj["value"]
+
+            return compare(obj, value)
+
+        return test
+
+    def query(self, qbbo, *fields):
+        """
+        A Query with the conditions QB can check itself on this type of
+        entity (see Query.can_filter), selecting fields (or *).
+        """
+
+        query = Query(qbbo, *fields)
+        for field, op, value in self.conditions:
+            if op in self._query_ops and Query.can_filter(qbbo, field, self._query_ops[op]):
+                query.where(field, self._query_ops[op], value)
+
+        return query
+
+    def where(self, qbbo):
+        """
+        The " WHERE ..." clause for the conditions QB can check itself on
+        this type of entity, or "" if there aren't any.
+        """
+
+        return self.query(qbbo).where_clause()
+
+class Query():
+    """
+    Builds a QBO query, e.g.
+
+        Query("Invoice", "Id", "DocNumber", "TotalAmt") \\
+            .where("TxnDate", ">=", datetime.date(2015, 1, 1)) \\
+            .where("CustomerRef", "IN", ["12", "15"]) \\
+            .order_by("TxnDate", descending=True)
+
+    is "SELECT Id, DocNumber, TotalAmt FROM Invoice WHERE TxnDate >=
+    '2015-01-01' AND CustomerRef IN ('12', '15') ORDERBY TxnDate DESC".
+    No fields means SELECT *; with fields, Id is always selected too
+    (everything gets keyed by it). Selecting just the fields you use makes
+    for a lot less to download and decode with wide entities like Invoice.
+
+    where() and order_by() check the field can be filtered (sorted) on for
+    that entity type, with that operator (see _filterable), so a bad query
+    fails here rather than as a ValidationFault from QB. Anything else can
+    go in tail(), unchecked. Queries go anywhere a query string does
+    (query_fetch_more, iter_query...).
+    """
+
+    #operators by the kind of field, see _filterable
+    _kind_ops = {
+        "id": ["=", "IN"],
+        "string": ["=", "IN", "LIKE"],
+        "number": ["=", "<", "<=", ">", ">="],
+        "date": ["=", "<", "<=", ">", ">="],
+        "bool": ["=", "IN"],
+    }
+
+    #what the QBO query language can filter on, by type
+    #https://developer.intuit.com/docs/api/accounting (each entity's "filterable" properties)
+    _filterable_all = {"Id": "id", "MetaData.CreateTime": "date", "MetaData.LastUpdatedTime": "date"}
+    _filterable_transaction = {"DocNumber": "string", "TxnDate": "date"}
+    _filterable_name = {"Active": "bool"}
+    _filterable = {
+        "Invoice": {"CustomerRef": "id", "TotalAmt": "number", "Balance": "number", "DueDate": "date"},
+        "Estimate": {"CustomerRef": "id", "TotalAmt": "number"},
+        "SalesReceipt": {"CustomerRef": "id", "TotalAmt": "number"},
+        "CreditMemo": {"CustomerRef": "id", "TotalAmt": "number"},
+        "Payment": {"CustomerRef": "id", "TotalAmt": "number"},
+        "Bill": {"VendorRef": "id", "TotalAmt": "number", "Balance": "number", "DueDate": "date"},
+        "BillPayment": {"VendorRef": "id", "TotalAmt": "number"},
+        "PurchaseOrder": {"VendorRef": "id", "TotalAmt": "number"},
+        "VendorCredit": {"VendorRef": "id", "TotalAmt": "number"},
+        "Purchase": {"TotalAmt": "number"},
+        "Customer": {"DisplayName": "string", "GivenName": "string", "FamilyName": "string", "CompanyName": "string",
+            "PrimaryEmailAddr": "string", "Balance": "number"},
+        "Vendor": {"DisplayName": "string", "GivenName": "string", "FamilyName": "string", "CompanyName": "string",
+            "PrimaryEmailAddr": "string", "Balance": "number"},
+        "Employee": {"DisplayName": "string", "GivenName": "string", "FamilyName": "string"},
+        "Account": {"Name": "string", "AccountType": "string", "Classification": "string", "CurrentBalance": "number"},
+        "Item": {"Name": "string", "Type": "string", "Sku": "string"},
+        "Class": {"Name": "string"},
+        "Department": {"Name": "string"},
+        "Term": {"Name": "string"},
+        "PaymentMethod": {"Name": "string"},
+        "TaxCode": {"Name": "string"},
+        "TaxRate": {"Name": "string"},
+        "Attachable": {"FileName": "string"},
+    }
+
+    _transactions = ["Bill", "BillPayment", "CreditMemo", "Estimate", "Invoice", "JournalEntry", "Payment", "Purchase",
+        "PurchaseOrder", "SalesReceipt", "TimeActivity", "VendorCredit"]
+    _names = ["Account", "Class", "Customer", "Department", "Employee", "Item", "PaymentMethod", "TaxCode", "TaxRate",
+        "Term", "Vendor"]
+
+    @classmethod
+    def filterable(cls, qbbo):
+        """
+        {field: kind} for everything a qbbo query can filter on.
+        """
+
+        fields = dict(cls._filterable_all)
+        if qbbo in cls._transactions:
+            fields.update(cls._filterable_transaction)
+        if qbbo in cls._names:
+            fields.update(cls._filterable_name)
+
+        fields.update(cls._filterable.get(qbbo, {}))
+        return fields
+
+    @classmethod
+    def can_filter(cls, qbbo, field, op="="):
+        kind = cls.filterable(qbbo).get(field)
+        return kind is not None and op.upper() in cls._kind_ops[kind]
+
+    @classmethod
+    def format(cls, value):
+        """
+        A value as a query literal.
+        """
+
+        if isinstance(value, _Literal):
+            return value
+
+        if isinstance(value, (list, tuple, set)):
+            return "(%s)" % ", ".join([cls.format(v) for v in value])
+
+        if isinstance(value, bool):
+            return "true" if value else "false"
+
+        if isinstance(value, (int, long, float)):
+            return str(value)
+
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+
+        return "'%s'" % unicode(value).replace("'", "\\'")
+
+    def __init__(self, qbbo, *fields):
+        self.qbbo = qbbo
+        self.fields = []
+        self.conditions = []
+        self.ordering = []
+        self._tail = ""
+        self.select(*fields)
+
+    def select(self, *fields):
+        for field in fields:
+            if field not in self.fields:
+                self.fields.append(field)
+
+        if self.fields and "Id" not in self.fields:
+            self.fields.insert(0, "Id")
+
+        return self
+
+    def where(self, field, op, value):
+        op = op.upper()
+        if not self.can_filter(self.qbbo, field, op):
+            kind = self.filterable(self.qbbo).get(field)
+            if kind is None:
+                raise Exception("Can't filter {} queries on {} (try one of: {})".format(
+                    self.qbbo, field, ", ".join(sorted(self.filterable(self.qbbo)))))
+
+            raise Exception("Can't use {} on {}.{} (only {})".format(op, self.qbbo, field, ", ".join(self._kind_ops[kind])))
+
+        if op == "IN":
+            if not isinstance(value, (list, tuple, set)) or not value:
+                raise Exception("IN needs a (non-empty) list of values, got {!r}".format(value))
+
+        self.conditions.append((field, op, value))
+        return self
+
+    def order_by(self, field, descending=False):
+        if field not in self.filterable(self.qbbo):
+            raise Exception("Can't sort {} queries by {}".format(self.qbbo, field))
+
+        self.ordering.append("%s %s" % (field, "DESC" if descending else "ASC"))
+        return self
+
+    def tail(self, query_tail):
+        """
+        Raw query text to add at the end, e.g. "WHERE Active IN (true,false)";
+        a WHERE tail gets ANDed with the where() conditions, and its ORDERBY
+        (if any) goes after the order_by() ones.
+        """
+
+        self._tail = query_tail.strip()
+        return self
+
+    def _clauses(self):
+        """
+        The WHERE clause (with whatever else the tail has) and the tail's
+        ORDERBY fields, split apart so each can be merged.
+        """
+
+        clauses = ["%s %s %s" % (field, op, self.format(value)) for field, op, value in self.conditions]
+        tail, ordering = self._tail, []
+        match = re.search(r"(?i)\bORDERBY\s+", tail)
+        if match:
+            tail, ordering = tail[:match.start()].strip(), [tail[match.end():].strip()]
+
+        if tail[:6].upper() == "WHERE ":
+            clauses.append(tail[6:])
+            tail = ""
+
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        return where + (" " + tail if tail else ""), ordering
+
+    def where_clause(self):
+        where, ordering = self._clauses()
+        return where + (" ORDERBY " + ", ".join(ordering) if ordering else "")
+
+    def text(self):
+        where, ordering = self._clauses()
+        query = u"SELECT %s FROM %s%s" % (", ".join(self.fields) or "*", self.qbbo, where)
+        if self.ordering or ordering:
+            query += " ORDERBY " + ", ".join(self.ordering + ordering)
+
+        return query
+
+    def __str__(self):
+        return self.text().encode("utf-8")
+
+    def __repr__(self):
+        return "Query(%r)" % self.text()
+
+class _Literal(unicode):
+    """
+    A criterion that's already a query literal (Query.format leaves it be).
+    """
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+
+    if isinstance(value, datetime.date):
+        return value
+
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+def _date_chunks(start_date, end_date, chunk="month"):
+    """
+    [(start, end), ...] covering start_date to end_date (both inclusive)
+    in chunk-sized periods: "month", "quarter" or "year" (calendar ones,
+    the first and last cut short to fit), a number of days, or None for
+    the whole range.
+    """
+
+    start, end = _as_date(start_date), _as_date(end_date)
+    if end < start:
+        raise Exception("The range ends ({}) before it starts ({})".format(end, start))
+
+    if not chunk:
+        return [(start, end)]
+
+    periods = []
+    while start <= end:
+        if isinstance(chunk, (int, long)):
+            next_start = start + datetime.timedelta(days=chunk)
+        else:
+            months = {"month": 1, "quarter": 3, "year": 12}.get(chunk)
+            if months is None:
+                raise Exception("Unknown chunk: {} (use month, quarter, year or a number of days)".format(chunk))
+
+            #the first of the next month/quarter/year boundary
+            month = (start.month - 1) // months * months + months
+            next_start = datetime.date(start.year + month // 12, month % 12 + 1, 1)
+
+        periods.append((start, min(end, next_start - datetime.timedelta(days=1))))
+        start = next_start
+
+    return periods
+
+class ReportTable():
+    """
+    A report flattened into columns, see QuickBooks.report_table. Each
+    Data row of the report's (nested) row tree is one row of the table:
+
+        period_start, period_end    the chunk of the range it came from
+        section                     the headers of the sections it's in,
+                                    joined with " / "
+        <one per report column>     by ColTitle (or ColType)
+        <title> Id                  the ids behind a column, where it has
+                                    any (e.g. the account or name)
+
+    Money-type columns are floats, in a numpy array if numpy is around or
+    a typed array.array("d") if not (blanks are NaN); the rest are lists
+    of strings. sum() and pivot() work on whole columns at once rather
+    than walking the rows.
+    """
+
+    _numeric_types = ("Money",)
+    _numeric_suffixes = ("_amt", "_amount", "_bal")
+
+    def __init__(self, columns=None, header=None):
+        self.columns = collections.OrderedDict(columns or [])
+        self.header = header or {}
+
+    def __len__(self):
+        for column in self.columns.itervalues():
+            return len(column)
+
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def names(self):
+        return self.columns.keys()
+
+    def rows(self):
+        """
+        The table a row (dict) at a time, for when that's easier.
+        """
+
+        names = self.columns.keys()
+        for values in zip(*self.columns.values()):
+            yield dict(zip(names, values))
+
+    @classmethod
+    def _is_numeric(cls, col_type):
+        return col_type in cls._numeric_types or col_type.endswith(cls._numeric_suffixes)
+
+    @classmethod
+    def from_report(cls, report, period=None, summaries=False):
+        """
+        Flattens one report response. With summaries=True the sections'
+        Summary rows are kept too (section ending in "(summary)").
+        """
+
+        titles = []
+        numeric = []
+        for i, column in enumerate(report.get("Columns", {}).get("Column", [])):
+            title = column.get("ColTitle") or column.get("ColType") or "col%d" % i
+            while title in titles or title in ("period_start", "period_end", "section"):
+                title += " (%d)" % i
+
+            titles.append(title)
+            numeric.append(cls._is_numeric(column.get("ColType", "")))
+
+        raw = [[] for title in titles]
+        ids = [[] for title in titles]
+        sections = []
+        #(rows, where we're at in them, section path), so sections nest
+        #without recursion and rows come out in report order
+        stack = [(report.get("Rows", {}).get("Row", []), 0, [])]
+        while stack:
+            rows, n, path = stack.pop()
+            while n < len(rows):
+                row = rows[n]
+                n += 1
+                if "Rows" in row or "Header" in row:
+                    label = (row.get("Header", {}).get("ColData") or [{}])[0].get("value") or row.get("group", "")
+                    #the section's insides (then its summary) before whatever follows it
+                    stack.append((rows, n, path))
+                    if summaries and "Summary" in row:
+                        stack.append(([{"ColData": row["Summary"]["ColData"], "_summary": True}], 0, path + [label]))
+
+                    stack.append((row.get("Rows", {}).get("Row", []), 0, path + [label]))
+                    break
+
+                cells = row.get("ColData", [])
+                if not cells:
+                    continue
+
+                sections.append(" / ".join(path) + (" (summary)" if row.get("_summary") else ""))
+                for i in range(len(titles)):
+                    cell = cells[i] if i < len(cells) else {}
+                    raw[i].append(cell.get("value", ""))
+                    ids[i].append(cell.get("id", ""))
+
+        count = len(sections)
+        columns = [
+            ("period_start", [period[0].isoformat() if period else report.get("Header", {}).get("StartPeriod", "")] * count),
+            ("period_end", [period[1].isoformat() if period else report.get("Header", {}).get("EndPeriod", "")] * count),
+            ("section", sections),
+        ]
+        for i, title in enumerate(titles):
+            columns.append((title, cls._typed(raw[i]) if numeric[i] else raw[i]))
+            if any(ids[i]):
+                columns.append(("%s Id" % title, ids[i]))
+
+        return cls(columns, report.get("Header", {}))
+
+    @staticmethod
+    def _typed(values):
+        """
+        Strings to a float column (NaN for blanks), or left as they are
+        if they aren't all numbers.
+        """
+
+        floats = array.array("d")
+        try:
+            for value in values:
+                floats.append(float(value) if value not in ("", None) else float("nan"))
+        except ValueError:
+            return values
+
+        if numpy is not None:
+            return numpy.frombuffer(floats, dtype=numpy.float64).copy()
+
+        return floats
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        One table out of several (e.g. the chunks of a report), in order;
+        a column some of them don't have is filled in with blanks.
+        """
+
+        tables = [table for table in tables if table is not None]
+        names = []
+        for table in tables:
+            for name in table.names():
+                if name not in names:
+                    names.append(name)
+
+        columns = []
+        for name in names:
+            parts = []
+            numeric = all(not isinstance(t.columns.get(name, []), list) for t in tables if name in t)
+            for table in tables:
+                if name in table:
+                    parts.append(table[name])
+                elif numeric:
+                    parts.append(array.array("d", [float("nan")]) * len(table))
+                else:
+                    parts.append([""] * len(table))
+
+            if not numeric:
+                merged = []
+                for part in parts:
+                    merged.extend(part)
+            elif numpy is not None:
+                merged = numpy.concatenate([numpy.asarray(part, dtype=numpy.float64) for part in parts]) if parts else numpy.zeros(0)
+            else:
+                merged = array.array("d")
+                for part in parts:
+                    merged.extend(part)
+
+            columns.append((name, merged))
+
+        return cls(columns, tables[0].header if tables else {})
+
+    def _groups(self, by):
+        """
+        (group keys in order, the group number of each row) for a column.
+        """
+
+        keys = []
+        numbers = {}
+        groups = array.array("l")
+        for value in self.columns[by]:
+            if value not in numbers:
+                numbers[value] = len(keys)
+                keys.append(value)
+
+            groups.append(numbers[value])
+
+        return keys, groups
+
+    def sum(self, column, by=None):
+        """
+        The total of a numeric column (blanks count as 0), or {group:
+        total} with by=<another column>.
+        """
+
+        values = self.columns[column]
+        if by is None:
+            if numpy is not None:
+                return float(numpy.nansum(values))
+
+            return math.fsum(value for value in values if value == value)
+
+        keys, groups = self._groups(by)
+        if numpy is not None:
+            values = numpy.nan_to_num(numpy.asarray(values, dtype=numpy.float64))
+            totals = numpy.bincount(numpy.frombuffer(groups, dtype=numpy.int64 if groups.itemsize == 8 else numpy.int32),
+                weights=values, minlength=len(keys))
+            return collections.OrderedDict(zip(keys, [float(total) for total in totals]))
+
+        totals = [0.0] * len(keys)
+        for group, value in zip(groups, values):
+            if value == value:
+                totals[group] += value
+
+        return collections.OrderedDict(zip(keys, totals))
+
+    def pivot(self, index, columns, values):
+        """
+        {index value: {columns value: total of values}}, e.g.
+        table.pivot("Account", "period_start", "Amount") for a month by
+        month summary of a GeneralLedger.
+        """
+
+        row_keys, row_groups = self._groups(index)
+        col_keys, col_groups = self._groups(columns)
+        data = self.columns[values]
+        if numpy is not None:
+            cells = numpy.asarray(row_groups, dtype=numpy.int64) * len(col_keys) + numpy.asarray(col_groups, dtype=numpy.int64)
+            totals = numpy.bincount(cells, weights=numpy.nan_to_num(numpy.asarray(data, dtype=numpy.float64)),
+                minlength=len(row_keys) * len(col_keys)).tolist()
+        else:
+            totals = [0.0] * (len(row_keys) * len(col_keys))
+            for r, c, value in zip(row_groups, col_groups, data):
+                if value == value:
+                    totals[r * len(col_keys) + c] += value
+
+        table = collections.OrderedDict()
+        for r, row_key in enumerate(row_keys):
+            table[row_key] = collections.OrderedDict(
+                (col_key, totals[r * len(col_keys) + c]) for c, col_key in enumerate(col_keys))
+
+        return table
+
+class HashIndex():
+    """
+    field value -> set of Ids, for the cached <Qbbo>s dicts (see
+    QuickBooks.add_index).
+
+    It remembers the values each Id went in under and takes it out by
+    those, since the entity may have been changed in place since.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.ids = {}
+        self.values = {}
+
+    def add(self, Id, entity):
+        values = self.values[Id] = _field_values(entity, self.field)
+        for value in values:
+            self.ids.setdefault(value, set()).add(Id)
+
+    def remove(self, Id):
+        for value in self.values.pop(Id, []):
+            ids = self.ids.get(value)
+            if ids is not None:
+                ids.discard(Id)
+                if not ids:
+                    del self.ids[value]
+
+    def rebuild(self, object_dict):
+        self.clear()
+        for Id, entity in object_dict.iteritems():
+            self.add(Id, entity)
+
+    def clear(self):
+        self.ids = {}
+        self.values = {}
+
+    def lookup(self, value):
+        return list(self.ids.get(value, []))
+
+class SortedIndex(HashIndex):
+    """
+    A HashIndex that also keeps the (value, Id) pairs sorted by value, so
+    ranges (e.g. of TxnDate) come out with a couple of bisects.
+    """
+
+    def __init__(self, field):
+        HashIndex.__init__(self, field)
+        self.keys = []
+        self.key_ids = []
+
+    def add(self, Id, entity):
+        HashIndex.add(self, Id, entity)
+        for value in self.values[Id]:
+            i = bisect.bisect_right(self.keys, value)
+            self.keys.insert(i, value)
+            self.key_ids.insert(i, Id)
+
+    def remove(self, Id):
+        values = self.values.get(Id, [])
+        HashIndex.remove(self, Id)
+        for value in values:
+            for i in range(bisect.bisect_left(self.keys, value), bisect.bisect_right(self.keys, value)):
+                if self.key_ids[i] == Id:
+                    del self.keys[i]
+                    del self.key_ids[i]
+                    break
+
+    def rebuild(self, object_dict):
+        HashIndex.rebuild(self, {})
+        pairs = []
+        for Id, entity in object_dict.iteritems():
+            HashIndex.add(self, Id, entity)
+            for value in self.values[Id]:
+                pairs.append((value, Id))
+
+        pairs.sort()
+        self.keys = [value for value, Id in pairs]
+        self.key_ids = [Id for value, Id in pairs]
+
+    def clear(self):
+        HashIndex.clear(self)
+        self.keys = []
+        self.key_ids = []
+
+    def range(self, low=None, high=None):
+        start = 0 if low is None else bisect.bisect_left(self.keys, low)
+        end = len(self.keys) if high is None else bisect.bisect_right(self.keys, high)
+        return self.key_ids[start:end]
+
+
+class _Lazy(object):
+    """
+    A nested value still in its JSON form, see CompactEntity.
+    """
+
+    __slots__ = ("json",)
+
+    def __init__(self, json_string):
+        self.json = json_string
+
+_missing = object()
+_interned = {}
+_intern_lock = threading.Lock()
+_intern_limit = 100000
+
+def _intern(value):
+    """
+    One shared copy of a (ref id or name) string, however many entities use it.
+
+    The table is bounded: once it has _intern_limit strings it starts over
+    (entities keep the strings they have, new ones just aren't shared with
+    them), so it can't outgrow the caches it serves.
+    """
+
+    try:
+        return _interned[value]
+    except KeyError:
+        with _intern_lock:
+            if len(_interned) >= _intern_limit:
+                _interned.clear()
+
+            return _interned.setdefault(value, value)
+
+class Ref(object):
+    """
+    A compact {"value": ..., "name": ...} reference (CustomerRef, ClassRef,
+    etc.) with interned strings. Reads like the dict it came from.
+    """
+
+    __slots__ = ("value", "name")
+
+    def __init__(self, value, name=None):
+        self.value = _intern(value)
+        self.name = None if name is None else _intern(name)
+
+    def __getitem__(self, key):
+        if key == "value":
+            return self.value
+        elif key == "name" and self.name is not None:
+            return self.name
+
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key == "value" or (key == "name" and self.name is not None)
+
+    def keys(self):
+        return ["value"] if self.name is None else ["value", "name"]
+
+    def __eq__(self, other):
+        if isinstance(other, (Ref, dict)):
+            return self.to_dict() == (other.to_dict() if isinstance(other, Ref) else other)
+
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return "Ref(%r)" % self.to_dict()
+
+    def to_dict(self):
+        if self.name is None:
+            return {"value": self.value}
+
+        return {"value": self.value, "name": self.name}
+
+class _Layout():
+    """
+    The field names of one entity type, in slot order. Shared by every
+    CompactEntity of that type, and grown as new fields turn up.
+    """
+
+    _layouts = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def for_type(cls, qbbo):
+        layout = cls._layouts.get(qbbo)
+        if layout is None:
+            with cls._lock:
+                layout = cls._layouts.setdefault(qbbo, cls(qbbo))
+
+        return layout
+
+    def __init__(self, qbbo):
+        self.qbbo = qbbo
+        self.fields = []
+        self.slots = {}
+
+    def slot(self, field):
+        i = self.slots.get(field)
+        if i is None:
+            with self._lock:
+                i = self.slots.get(field)
+                if i is None:
+                    self.fields.append(field)
+                    i = self.slots[field] = len(self.fields) - 1
+
+        return i
+
+class CompactEntity(object):
+    """
+    A __slots__ record standing in for an entity dict, for keeping lots of
+    them around (QuickBooks(compact=True) uses these for the <Qbbo>s dicts
+    and query results). Field names live once per type (_Layout), scalar
+    values sit in a plain list, refs become Refs with interned ids and
+    names, and Line (like any other nested structure) stays a JSON string
+    until it's first accessed.
+
+    It reads (and writes) like the dict it replaces: entity["Id"],
+    entity.get("Line", []), "ClassRef" in entity... and to_dict() gives
+    the plain dict back. Indexing and to_dict() (so JSON encoding too) go
+    through peek(), so Line only stays decoded if you touch it yourself.
+    """
+
+    __slots__ = ("_layout", "_values")
+
+    def __init__(self, qbbo, entity):
+        self._layout = _Layout.for_type(qbbo)
+        self._values = []
+        for key, value in entity.iteritems():
+            self[key] = value
+
+    @property
+    def qbbo(self):
+        return self._layout.qbbo
+
+    def _pack(self, value):
+        if isinstance(value, dict):
+            if "value" in value and set(value.keys()) <= set(["value", "name"]):
+                return Ref(value["value"], value.get("name"))
+
+            return _Lazy(_codec.dumps(value))
+
+        elif isinstance(value, list):
+            return _Lazy(_codec.dumps(value))
+
+        return value
+
+    def __setitem__(self, key, value):
+        i = self._layout.slot(key)
+        if i >= len(self._values):
+            self._values.extend([_missing] * (i + 1 - len(self._values)))
+
+        self._values[i] = self._pack(value)
+
+    def __getitem__(self, key):
+        i = self._layout.slots.get(key)
+        if i is None or i >= len(self._values) or self._values[i] is _missing:
+            raise KeyError(key)
+
+        value = self._values[i]
+        if isinstance(value, _Lazy):
+            value = self._values[i] = _codec.loads(value.json)
+
+        return value
+
+    def peek(self, key, default=None):
+        """
+        get(), but a nested value still in its JSON form is decoded just
+        for the caller and left as it was (changing it changes nothing).
+        """
+
+        i = self._layout.slots.get(key)
+        if i is None or i >= len(self._values) or self._values[i] is _missing:
+            return default
+
+        value = self._values[i]
+        return _codec.loads(value.json) if isinstance(value, _Lazy) else value
+
+    def __delitem__(self, key):
+        self[key]
+        self._values[self._layout.slots[key]] = _missing
+
+    def __contains__(self, key):
+        i = self._layout.slots.get(key)
+        return i is not None and i < len(self._values) and self._values[i] is not _missing
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [field for field, value in zip(self._layout.fields, self._values) if value is not _missing]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, (CompactEntity, dict)):
+            return self.to_dict() == (other.to_dict() if isinstance(other, CompactEntity) else other)
+
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return "CompactEntity(%r, %r)" % (self.qbbo, self.to_dict())
+
+    def to_dict(self):
+        entity = {}
+        for key in self.keys():
+            value = self.peek(key)
+            if isinstance(value, Ref):
+                value = value.to_dict()
+
+            entity[key] = value
+
+        return entity
+
+_mapping_types = (dict, CompactEntity, Ref)
+
+def _json_default(obj):
+    """
+    Lets json.dumps handle CompactEntity and Ref.
+    """
+
+    if isinstance(obj, (CompactEntity, Ref)):
+        return obj.to_dict()
+
+    raise TypeError("%r is not JSON serializable" % obj)
+
+class JSONCodec():
+    """
+    The JSON library request/response bodies (and cached entities) go
+    through. Picks the fastest one installed (ujson, rapidjson, simplejson)
+    unless told which, falling back to the stdlib json module.
+
+    Bodies are compact on the wire; pretty=True is for verbose printing.
+    """
+
+    _preferred = ("ujson", "rapidjson", "simplejson")
+
+    def __init__(self, module=None):
+        if module is None:
+            module = json
+            for name in self._preferred:
+                try:
+                    module = __import__(name)
+                    break
+                except ImportError:
+                    pass
+
+        elif isinstance(module, basestring):
+            module = __import__(module)
+
+        self.module = module
+        self.name = module.__name__
+
+    def loads(self, s):
+        return self.module.loads(s)
+
+    def dumps(self, obj, pretty=False):
+        if pretty:
+            return json.dumps(obj, indent=4, default=_json_default)
+
+        if self.module is not json:
+            try:
+                return self.module.dumps(obj, default=_json_default)
+            except (TypeError, OverflowError):
+                #older ujsons don't take default= (or choke on CompactEntity)
+                pass
+
+        return json.dumps(obj, separators=(",", ":"), default=_json_default)
+
+_codec = JSONCodec()
+
+def set_json_codec(module=None):
+    """
+    Switches the JSON library in use, e.g. set_json_codec("simplejson"), or
+    set_json_codec(json) for the stdlib one. None picks the fastest installed.
+    """
+
+    global _codec
+    _codec = JSONCodec(module)
+    return _codec
+
+
+class ThreadedQuickBooks():
+    """
+    QuickBooks on a thread pool: same arguments, same methods, but the
+    network-bound ones are handed to the pool and return an AsyncResult
+    right away. Call .get() on it when you actually need the data, e.g.
+
+        tqb = ThreadedQuickBooks(max_workers=50, **creds)
+        pending = [tqb.read_object("Invoice", Id) for Id in ids]
+        invoices = [p.get() for p in pending]
+
+    The requests themselves still block, each one holding a pool thread
+    while it's out, so no more than max_workers are ever in flight (the
+    rest wait their turn). For thousands at once, run under gevent with
+    monkey.patch_all() first: the pool's threads become greenlets, and a
+    max_workers in the thousands costs next to nothing.
+
+    Everything else (cached <Qbbo>s dicts, tokens, etc.) is read straight off
+    the wrapped QuickBooks instance.
+    """
+
+    _async_methods = ["create_object", "read_object", "update_object", "delete_object", "query_objects",
+        "query_fetch_more", "get_objects", "object_dicts", "names", "transactions", "get_report",
+        "upload_file", "upload_files", "download_file", "download_files", "fetch_customer", "fetch_customers", "fetch_invoices",
+        "fetch_purchases", "fetch_journal_entries", "fetch_bills"
+    ]
+
+    def __init__(self, **args):
+        self._own_client = "client" not in args
+        self.client = args.pop("client", None) or QuickBooks(**args)
+        self.max_workers = args.get("max_workers", 10)
+
+        # a pool can be passed in so that several realms share the same threads
+        self._own_pool = "pool" not in args
+        self.pool = args.get("pool") or ThreadPool(self.max_workers)
+
+    def __getattr__(self, name):
+        if name in self._async_methods:
+            method = getattr(self.client, name)
+            def submit(*a, **kw):
+                return self.submit(method, *a, **kw)
+
+            return submit
+
+        return getattr(self.client, name)
+
+    def submit(self, func, *a, **kw):
+        """
+        Runs func(*a, **kw) on the pool, returns the AsyncResult.
+        A "callback" kwarg, if given, is called with the result once it's in.
+        """
+
+        callback = kw.pop("callback", None)
+        self.client._create_session_by_demand()
+        return self.pool.apply_async(func, a, kw, callback)
+
+    def close(self):
+        if self._own_pool:
+            self.pool.close()
+            self.pool.join()
+
+        if self._own_client:
+            self.client.close()
+
+class QuickBooksPool():
+    """
+    A registry of per-realm clients for serving lots of companies from one
+    process. Every client it hands out shares one keep-alive HTTP connection
+    pool, one pool of query workers and (for threaded_client) one executor,
+    while keeping its own rate limit and cap on concurrent requests.
+
+        pool = QuickBooksPool(consumer_key=key, consumer_secret=secret, max_cached_objects=2000000)
+        qb = pool.client(company_id, access_token=token, access_token_secret=token_secret)
+
+    Whatever is passed to the pool is the default for every client; client()
+    takes the per-realm extras, remembers them and can rebuild the client
+    from them later. Passing the same ones again keeps the client (and its
+    caches); different ones (say, refreshed tokens) make a new one. To cap
+    memory, the cached <Qbbo>s dicts of the least recently used idle realms
+    get dropped once there are more than max_cached_objects entities cached
+    overall (a running total the clients keep up to date), and idle clients
+    beyond max_clients are dropped altogether.
+    """
+
+    def __init__(self, **args):
+        self.max_clients = args.pop("max_clients", 1000)
+        self.max_cached_objects = args.pop("max_cached_objects", None)
+        workers = args.pop("workers", 20)
+        connections = args.pop("connections", 100)
+
+        self.http_adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=connections)
+        self.query_pool = ThreadPool(args.pop("query_workers", workers))
+        self.executor = ThreadPool(workers)
+
+        self.defaults = args
+        self._realm_args = {}
+        self._clients = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+        #entities cached across all the clients, kept up to date by them
+        self.cached_objects = 0
+        self._count_lock = threading.Lock()
+
+    def client(self, company_id, **args):
+        """
+        The QuickBooks client for this realm, made if need be, or remade
+        if it's given different arguments than last time.
+        """
+
+        company_id = str(company_id)
+        with self._lock:
+            if args and args != self._realm_args.get(company_id):
+                self._realm_args[company_id] = args
+                self._forget(company_id)
+
+            if company_id in self._clients:
+                qb = self._clients.pop(company_id)
+            else:
+                client_args = dict(self.defaults)
+                client_args.update(self._realm_args.get(company_id, {}))
+                client_args.update({"company_id": company_id, "http_adapter": self.http_adapter,
+                    "query_pool": self.query_pool, "on_cache_change": self._count_cached
+                })
+
+                qb = QuickBooks(**client_args)
+
+            #most recently used goes last
+            self._clients[company_id] = qb
+            self._evict()
+
+        return qb
+
+    def threaded_client(self, company_id, **args):
+        """
+        A ThreadedQuickBooks for this realm, running on the pool's executor.
+        """
+
+        return ThreadedQuickBooks(client=self.client(company_id, **args), pool=self.executor)
+
+    def realms(self):
+        with self._lock:
+            return self._clients.keys()
+
+    def drop(self, company_id):
+        """
+        Forgets a realm's client (and its caches) along with its arguments.
+        """
+
+        with self._lock:
+            self._forget(str(company_id))
+            self._realm_args.pop(str(company_id), None)
+
+    def _forget(self, company_id):
+        qb = self._clients.pop(company_id, None)
+        if qb is not None:
+            #it's not ours to count any more
+            qb.on_cache_change = None
+            self._count_cached(-qb.cached_object_count())
+
+    def _count_cached(self, delta):
+        with self._count_lock:
+            self.cached_objects += delta
+
+    def _idle(self, qb):
+        return qb.rate_limiter.in_flight == 0
+
+    def _evict(self):
+        while len(self._clients) > self.max_clients:
+            idle = [company_id for company_id, qb in self._clients.iteritems() if self._idle(qb)]
+            if not idle:
+                break
+
+            self._forget(idle[0])
+
+        if self.max_cached_objects is None or self.cached_objects <= self.max_cached_objects:
+            return
+
+        #least recently used first
+        for qb in self._clients.values():
+            if self.cached_objects <= self.max_cached_objects:
+                break
+
+            if qb.cached_object_count() and self._idle(qb):
+                qb.clear_caches()
+
+    def stats(self):
+        """
+        Cached entities and limiter state per realm.
+        """
+
+        with self._lock:
+            return dict([(company_id, {"cached_objects": qb.cached_object_count(), "limiter": qb.limiter_state()})
+                for company_id, qb in self._clients.iteritems()
+            ])
+
+    def close(self):
+        self.executor.close()
+        self.query_pool.close()
+        self.executor.join()
+        self.query_pool.join()